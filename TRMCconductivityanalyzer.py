@@ -1,46 +1,136 @@
+"""
+Difference between a linear regression of the conductance and its minimum for TRMC trace files
+
+python TRMCconductivityanalyzer.py
+    pick a file in a dialog, plot it and print the difference
+python TRMCconductivityanalyzer.py "data/*.csv" data/other_folder -o summary.csv -j 4
+    headless, every file matching a glob and every trace file (*_data.csv) in a directory on a pool of workers,
+    one row per file in summary.csv
+
+tkinter and matplotlib are only imported for the dialog.
+"""
 #imports
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import tkinter as tk
-import statsmodels.api as sm
-from tkinter import filedialog
-
-#gets data from CSV with conductance data
-root = tk.Tk()
-root.withdraw()
-FN = filedialog.askopenfilename()
-data1 = pd.read_csv(FN,skiprows = 13, usecols = [0,2])
-data1.columns= ['Time(ns)','Conductance(S)']
-data1['Time(ns)'] = data1['Time(ns)'].apply(lambda x: x*1e9)
-
-#Get predictions
-X = data1['Time(ns)'] ## X usually means our input variables (or independent variables)
-y = data1['Conductance(S)'] ## Y usually means our output/dependent variable
-X = sm.add_constant(X) ## adds an intercept (beta_0) to our model
-model = sm.OLS(y, X).fit() ## sm.OLS(output, input)
-predictions = model.predict(X)
-
-#Add predictions to dataframe
-data1['Linear Regression']= predictions
-
-#plot
-ax = plt.gca()
-data1.plot(kind='scatter',logy=True, x='Time(ns)',y='Conductance(S)',ax=ax, s=.5)
-data1.plot(kind='scatter',logy=True, x='Time(ns)',y='Linear Regression',ax=ax,color='red',s=.5)
-ax.set_ylabel("Conductance(S)")
-plt.autoscale(enable=True, axis='y')
-
-#finds minimum and index
-Min = data1['Conductance(S)'].min()
-val_mask = data1['Conductance(S)'] == Min
-ind = data1['Conductance(S)'][val_mask].index
-
-# finds value of lin regression at index
-pt = data1['Linear Regression'][ind].values
-
-#Finds and displays difference
-Diff=pt-Min
-print('The difference between the minimum and linear regression is',Diff[0],'volts for', FN)
-
-#Display dataframe. Just uncomment if you want it.
-data1.head()
\ No newline at end of file
+
+
+def load_data(FN):
+    """time (ns) and conductance (S) columns of a trace file"""
+    data1 = pd.read_csv(FN,skiprows = 13, usecols = [0,2])
+    data1.columns= ['Time(ns)','Conductance(S)']
+    data1['Time(ns)'] = data1['Time(ns)']*1e9
+    return data1
+
+def linfit(x, y):
+    """closed form least squares line, returns intercept and slope"""
+    xm, ym = x.mean(), y.mean()
+    slope = np.sum((x - xm)*(y - ym))/np.sum((x - xm)**2)
+    return ym - slope*xm, slope
+
+def analyze(x, y):
+    """regression at the (first) minimum of y minus the minimum"""
+    intercept, slope = linfit(x, y)
+    ind = np.argmin(y)
+    pt = intercept + slope*x[ind]
+    return {'min' : y[ind], 'min_time' : x[ind], 'regression' : pt, 'diff' : pt - y[ind],
+            'intercept' : intercept, 'slope' : slope}
+
+def analyze_file(FN):
+    """summary row of one file, errors are returned rather than raised"""
+    try:
+        data1 = load_data(FN)
+        row = analyze(data1['Time(ns)'].values, data1['Conductance(S)'].values)
+        row['error'] = None
+    except Exception as e:
+        row = {'error' : repr(e)}
+    row['file'] = FN
+    return row
+
+def find_files(patterns, suffix = '_data.csv'):
+    """
+    files matching globs, directories are expanded to the trace files in them (names ending in suffix)
+
+    returns the files and the other files found in the directories (dark cavity sweeps etc.), which are skipped
+    """
+    fns, skipped = [], []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for fn in os.listdir(pattern):
+                fp = os.path.join(pattern, fn)
+                if fn.endswith(suffix):
+                    fns.append(fp)
+                elif os.path.isfile(fp):
+                    skipped.append(fp)
+        else:
+            fns += glob.glob(pattern)
+    return sorted(set(fns)), sorted(set(skipped))
+
+def batch(fns, workers = None):
+    """summary DataFrame of every file, workers = 1 runs in this process"""
+    if workers == 1:
+        rows = [analyze_file(FN) for FN in fns]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as ex:
+            rows = list(ex.map(analyze_file, fns, chunksize = max(1, len(fns)//(4*(workers or os.cpu_count() or 1)))))
+    columns = ['file','min','min_time','regression','diff','intercept','slope','error']
+    return pd.DataFrame(rows, columns = columns)
+
+def gui():
+    """the original single file dialog and plot"""
+    import tkinter as tk
+    from tkinter import filedialog
+    import matplotlib.pyplot as plt
+
+    #gets data from CSV with conductance data
+    root = tk.Tk()
+    root.withdraw()
+    FN = filedialog.askopenfilename()
+    data1 = load_data(FN)
+
+    #Add predictions to dataframe
+    intercept, slope = linfit(data1['Time(ns)'].values, data1['Conductance(S)'].values)
+    data1['Linear Regression'] = intercept + slope*data1['Time(ns)']
+
+    #plot
+    ax = plt.gca()
+    data1.plot(kind='scatter',logy=True, x='Time(ns)',y='Conductance(S)',ax=ax, s=.5)
+    data1.plot(kind='scatter',logy=True, x='Time(ns)',y='Linear Regression',ax=ax,color='red',s=.5)
+    ax.set_ylabel("Conductance(S)")
+    plt.autoscale(enable=True, axis='y')
+
+    #Finds and displays difference
+    Diff = analyze(data1['Time(ns)'].values, data1['Conductance(S)'].values)['diff']
+    print('The difference between the minimum and linear regression is',Diff,'volts for', FN)
+    plt.show()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Difference between the linear regression and the minimum of the conductance')
+    parser.add_argument('paths', nargs = '*', help = 'files, globs or directories, none opens a file dialog')
+    parser.add_argument('-o', '--output', default = 'conductance_summary.csv', help = 'summary csv')
+    parser.add_argument('-j', '--workers', type = int, default = None, help = 'number of processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    if not args.paths:
+        gui()
+        return 0
+
+    fns, skipped = find_files(args.paths)
+    if skipped:
+        print('skipped {} file(s) that are not traces (*_data.csv), e.g. {}'.format(len(skipped), os.path.basename(skipped[0])))
+    if not fns:
+        print('no files found for', ' '.join(args.paths))
+        return 1
+    df = batch(fns, args.workers)
+    df.to_csv(args.output, index = False)
+    print('{} files, {} failed, summary written to {}'.format(len(df), df['error'].notnull().sum(), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
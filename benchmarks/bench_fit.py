@@ -0,0 +1,65 @@
+"""
+Benchmark of the sweep fits with and without the analytic jacobians and closed form guesses
+
+python benchmarks/bench_fit.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.optimize
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the trmc of this checkout
+from trmc import analysis
+
+freq = np.linspace(8.50e9, 8.56e9, 601)
+window = 100
+bounds = ([0,0,0,0],[np.inf,np.inf,np.inf,np.inf])
+
+
+def make_sweeps(N, seed = 0):
+    rng = np.random.default_rng(seed)
+    f0 = 8.53e9 + rng.normal(0, 2e6, N)
+    R0 = rng.uniform(0.002, 0.01, N)
+    w = rng.uniform(5e6, 1.5e7, N)
+    y = analysis.lor(freq, f0[:,np.newaxis], R0[:,np.newaxis], 0.02, w[:,np.newaxis])
+    return y + rng.normal(0, 1e-4, y.shape)
+
+
+def run(sweeps, guess, jac):
+    """fit every sweep, returns time and mean number of model evaluations (including finite differences)"""
+    calls = [0]
+    def lor(*args):
+        calls[0] += 1
+        return analysis.lor(*args)
+
+    t_start = time.perf_counter()
+    for y in sweeps:
+        minidx = y.argmin()
+        sl = slice(minidx-window, minidx+window+1)
+        if guess:
+            p0 = analysis.lor_guess(freq[sl], y[sl])
+        else:
+            p0 = [freq[minidx], 0.005, 0.02, 1e7] # the old p0 with f0 from idxmin
+        scipy.optimize.curve_fit(lor, freq[sl], y[sl], p0, bounds = bounds, jac = analysis.lor_jac if jac else None)
+    return time.perf_counter() - t_start, calls[0]/len(sweeps)
+
+
+def main(N = 500):
+    sweeps = make_sweeps(N)
+    print('{} sweeps'.format(N))
+    print('{:>8} {:>6} {:>10} {:>8}'.format('guess', 'jac', 'time (s)', 'evals'))
+    for guess in (False, True):
+        for jac in (False, True):
+            el, nfev = run(sweeps, guess, jac)
+            print('{:>8} {:>6} {:>10.3g} {:>8.1f}'.format(str(guess), str(jac), el, nfev))
+
+    da = analysis.xr.DataArray(sweeps, dims = ['time','freq'], coords = {'time' : np.arange(N), 'freq' : freq})
+    t_start = time.perf_counter()
+    analysis.fitsweeps(da, window = window, warm_dim = None)
+    print('fitsweeps (batched): {:.3g} s'.format(time.perf_counter() - t_start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark of kin.calc_n (numpy and numba kernels) against the original quadratic implementation
+
+python benchmarks/bench_kin.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the trmc of this checkout
+from trmc import kin, kernels
+
+trapz = getattr(np, 'trapezoid', None) or np.trapz
+
+params = {'FWHM' : 5e-9, 't0' : 20e-9, 'FA' : 0.9, 'd' : 500e-7}
+k1, k2, k3 = 1e7, 1e-10, 1e-28
+I0 = 1e14
+
+
+def calc_n_ref(dng,k1,k2,k3):
+    """The original calc_n, re-integrates the whole prefix every step"""
+    t = dng.index
+    n = pd.Series(np.zeros(len(t)),index = t)
+    for i in range(1,len(t)):
+        dng_t = dng.iloc[:i-1]
+        dnr_t = kin.dnr(n.iloc[:i-1],k1,k2,k3)
+        dn_t = dng_t + dnr_t
+        n.iloc[i] = trapz(dn_t,t[:i-1])
+    return n
+
+
+def timeit(fn, *args, **kwargs):
+    t_start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t_start
+
+
+def main(sizes = (500, 1000, 2000, 10000), ref_max = 2000):
+    print('backends: ' + ', '.join(kernels.backends))
+    print('{:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'N', 'ref (s)', 'cumtrapz', 'ct numba', 'heun', 'h numba', 'ode', 'max rel err', 'heun vs ode'))
+    for backend in kernels.backends:
+        # compile (or load the numba cache) outside of the timings
+        kin.calc_n(np.zeros(10), k1, k2, k3, t = np.arange(10.), backend = backend)
+        kin.calc_n(np.zeros(10), k1, k2, k3, t = np.arange(10.), backend = backend, method = 'heun')
+    for N in sizes:
+        t = np.linspace(0, 500e-9, N)
+        power, dng = kin.calc_pow(t, I0, params)
+
+        n_ct, t_ct = timeit(kin.calc_n, dng, k1, k2, k3, backend = 'numpy')
+        n_h, t_h = timeit(kin.calc_n, dng, k1, k2, k3, method = 'heun', backend = 'numpy')
+        n_o, t_o = timeit(kin.calc_n, dng, k1, k2, k3, method = 'ode')
+        if 'numba' in kernels.backends:
+            n_ct_nb, t_ct_nb = timeit(kin.calc_n, dng, k1, k2, k3, backend = 'numba')
+            n_h_nb, t_h_nb = timeit(kin.calc_n, dng, k1, k2, k3, method = 'heun', backend = 'numba')
+            assert n_ct_nb.equals(n_ct) and n_h_nb.equals(n_h)
+        else:
+            t_ct_nb, t_h_nb = np.nan, np.nan
+
+        if N <= ref_max:
+            n_ref, t_ref = timeit(calc_n_ref, dng, k1, k2, k3)
+            err = np.abs(n_ct - n_ref).max()/np.abs(n_ref).max()
+        else:
+            t_ref, err = np.nan, np.nan
+        err_ho = np.abs(n_h - n_o).max()/np.abs(n_o).max()
+
+        print('{:>7} {:>10.3g} {:>10.3g} {:>10.3g} {:>10.3g} {:>10.3g} {:>10.3g} {:>12.2e} {:>12.2e}'.format(
+            N, t_ref, t_ct, t_ct_nb, t_h, t_h_nb, t_o, err, err_ho))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark of load.sweeps2ds against the original expand_dims + xr.merge assembly
+
+python benchmarks/bench_sweeps.py
+"""
+import os
+import re
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # the trmc of this checkout
+from trmc import load
+
+
+def sweeps2ds_ref(fps, regex = 'Sweep_(\d+)ms(.+)exp.csv', groupnames = ['swtime','tc']):
+    """The original sweeps2ds, one DataArray per sweep merged at the end"""
+    das = []
+    for samp in fps:
+        direc = fps[samp]
+        for fn in os.listdir(direc):
+            m = re.search(regex,fn)
+            if m is None:
+                continue
+            s = load.loadsweep(os.path.join(direc,fn))
+            s = s.rename(s.name.replace(' ', ''))
+            s.index = s.index.rename('freq')
+            da = xr.DataArray.from_series(s)
+            da = da.assign_coords(sample = samp).expand_dims('sample')
+            for i, nm in enumerate(groupnames):
+                da = da.assign_coords(temp = m.groups()[i]).expand_dims('temp')
+                da = da.rename({'temp':nm})
+            das.append(da)
+    return xr.merge(das)
+
+
+def make_sweeps(root, N, nsamp = 2, nf = 201, seed = 0):
+    """N sweep files spread over nsamp sample folders, with a few frequency grids"""
+    rng = np.random.default_rng(seed)
+    fps = {}
+    for k in range(N):
+        samp = 'samp{}'.format(k % nsamp)
+        direc = fps.setdefault(samp, os.path.join(root, samp))
+        os.makedirs(direc, exist_ok = True)
+        f = np.linspace(8.50, 8.56, nf) + 1e-4*(k % 3)
+        data = np.column_stack([f*1e9, rng.normal(0.02, 1e-3, nf), np.ones(nf)])
+        fn = 'Sweep_{}ms{}_exp.csv'.format(10*(k//(2*nsamp)), 'tc{}'.format(k//nsamp % 2))
+        np.savetxt(os.path.join(direc, fn), data, delimiter = ',', header = 'f(Ghz), Vsignal(V),Experimental R', comments = '')
+    return fps
+
+
+def timeit(fn, *args, **kwargs):
+    t_start = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t_start
+
+
+def main(sizes = (10, 100, 1000), ref_max = 1000):
+    print('{:>7} {:>10} {:>10} {:>10}'.format('sweeps', 'ref (s)', 'new (s)', 'identical'))
+    for N in sizes:
+        with tempfile.TemporaryDirectory() as root:
+            fps = make_sweeps(root, N)
+            ds, t_new = timeit(load.sweeps2ds, fps)
+            if N <= ref_max:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', FutureWarning)
+                    ds_ref, t_ref = timeit(sweeps2ds_ref, fps)
+                same = ds.identical(ds_ref)
+            else:
+                t_ref, same = np.nan, ''
+        print('{:>7} {:>10.3g} {:>10.3g} {:>10}'.format(N, t_ref, t_new, str(same)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Benchmark suite of loading, sweep fitting, kinetics and plotting at several scales on synthetic data
+
+python benchmarks/run.py                          every scale, written to benchmarks/results/<commit>.json
+python benchmarks/run.py -s small -o small.json   one scale
+python benchmarks/run.py --compare old.json new.json
+
+Each result holds the minimum and median wall time of the repeats and the per stage totals of
+trmc.timing for the last repeat, with the commit, versions and machine it was run on.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo) # the trmc of this checkout
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+from trmc import load, analysis, kin, kernels, plot, timing
+
+results_dir = os.path.join(repo, 'benchmarks', 'results')
+
+scales = {
+    'small' : {'freqs' : 5, 'fluences' : 3, 'ntime' : 1000, 'samples' : 2, 'swtimes' : 10, 'ks' : 4, 'plot_time' : 1000, 'plot_freq' : 50},
+    'medium' : {'freqs' : 20, 'fluences' : 5, 'ntime' : 2000, 'samples' : 4, 'swtimes' : 25, 'ks' : 6, 'plot_time' : 5000, 'plot_freq' : 100},
+    'large' : {'freqs' : 50, 'fluences' : 5, 'ntime' : 5000, 'samples' : 8, 'swtimes' : 50, 'ks' : 10, 'plot_time' : 20000, 'plot_freq' : 200},
+}
+
+kin_params = {'FWHM' : 5e-9, 't0' : 20e-9, 'FA' : 0.9, 'd' : 500e-7}
+
+
+def quiet(fn, *args, **kwargs):
+    """fn without its prints (freqfluence_flist reports every file it skips)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+def make_data(root, scale):
+    """write the synthetic trees of a scale under root, returns the inputs of the cases"""
+    c = scales[scale]
+    freqs = 8.50e9 + 1e7*np.arange(c['freqs'])
+    fluences = np.logspace(12, 15, c['fluences'])
+    direc = synthetic.freqfluence_tree(os.path.join(root, 'freqfluence'), freqs, fluences = fluences, ntime = c['ntime'])
+    fps = synthetic.sweep_tree(os.path.join(root, 'sweeps'), c['samples'], c['swtimes'])
+
+    s_fps = quiet(load.freqfluence_flist, direc)
+    synthetic.check_headers(s_fps.values)
+
+    t = np.linspace(0, 500e-9, c['ntime'])
+    ks = kin.k_grid(*[np.logspace(lo, hi, c['ks']) for lo, hi in [(6, 8), (-11, -9), (-29, -27)]])
+    return {'direc' : direc, 'fps' : fps, 't' : t, 'ks' : ks,
+            's_fps' : s_fps,
+            's_dcs' : load.freqdcs_flist(direc),
+            'sweeps' : load.sweeps2ds(fps)['Vsignal(V)'],
+            'dng' : kin.calc_dng(t, [1e14], kin_params)[0],
+            'dvs' : synthetic.deltav(c['plot_time'], c['plot_freq'])}
+
+
+def _draw(fig):
+    fig.canvas.draw()
+    plt.close(fig)
+
+def _dvcolorplot(d):
+    fig, axes = plot.dvcolorplot(d['dvs'].isel(time = 0), d['dvs'])
+    _draw(fig)
+
+def _absplot(d):
+    plot.absplot(d['dvs'])
+    _draw(plt.gcf())
+
+cases = {
+    'load.freqfluence_flist' : lambda d: quiet(load.freqfluence_flist, d['direc']),
+    'load.freqdcs_flist' : lambda d: load.freqdcs_flist(d['direc']),
+    'load.read_params' : lambda d: [load.read_params(fp) for fp in d['s_fps'].values],
+    'load.freqfluence_load' : lambda d: load.freqfluence_load(d['s_fps'], dense = True),
+    'load.sweeps2ds' : lambda d: load.sweeps2ds(d['fps']),
+    'fit.fit_dcs' : lambda d: analysis.fit_dcs(d['s_dcs'], workers = 1),
+    'fit.fitsweeps' : lambda d: analysis.fitsweeps(d['sweeps'], warm_dim = 'swtime'),
+    'kin.calc_n' : lambda d: kin.calc_n(d['dng'], 1e7, 1e-10, 1e-28, t = d['t']),
+    'kin.calc_n_batch' : lambda d: kin.calc_n_batch(d['t'], [1e12, 1e13, 1e14], kin_params, d['ks']),
+    'plot.dvcolorplot' : _dvcolorplot,
+    'plot.absplot' : _absplot,
+}
+
+
+def run_case(fn, d, repeats):
+    """min and median seconds of the repeats and the trmc.timing stages of the last one"""
+    times = []
+    timing.enable()
+    try:
+        for i in range(repeats):
+            timing.reset()
+            t_start = time.perf_counter()
+            fn(d)
+            times.append(time.perf_counter() - t_start)
+        stages = timing.report()[timing.columns].to_dict(orient = 'index')
+    finally:
+        timing.disable()
+        timing.reset()
+    return {'seconds' : min(times), 'median' : float(np.median(times)), 'repeats' : repeats, 'stages' : stages}
+
+def run(scale_names, repeats = 3, select = None):
+    """results of every case (or those starting with one of select) for each scale"""
+    results = {}
+    for scale in scale_names:
+        with tempfile.TemporaryDirectory() as root:
+            d = make_data(root, scale)
+            for name in cases:
+                # first call compiles the numba kernels and warms the caches
+                cases[name](d)
+            results[scale] = {}
+            for name, fn in cases.items():
+                if select and not any(name.startswith(s) for s in select):
+                    continue
+                results[scale][name] = run_case(fn, d, repeats)
+                print('{:>7} {:<24} {:>10.4g} s'.format(scale, name, results[scale][name]['seconds']))
+    return results
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd = repo, capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """commit, versions and machine of this run"""
+    import scipy, pandas, xarray
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {'commit' : _git('rev-parse', 'HEAD'),
+            'dirty' : bool(status) if status is not None else None,
+            'date' : datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'python' : platform.python_version(), 'numpy' : np.__version__, 'scipy' : scipy.__version__,
+            'pandas' : pandas.__version__, 'xarray' : xarray.__version__, 'matplotlib' : matplotlib.__version__,
+            'kin_backend' : kernels.backend, 'machine' : platform.platform(), 'cpus' : os.cpu_count()}
+
+def default_output(env):
+    name = (env['commit'] or 'nogit')[:10] + ('-dirty' if env['dirty'] else '')
+    return os.path.join(results_dir, name + '.json')
+
+def compare(old_fp, new_fp, threshold = 1.2):
+    """print the cases of two result files side by side, ratios above threshold are marked slower"""
+    with open(old_fp) as f:
+        old = json.load(f)
+    with open(new_fp) as f:
+        new = json.load(f)
+    print('{} -> {}'.format(old['env']['commit'], new['env']['commit']))
+    print('{:>7} {:<24} {:>10} {:>10} {:>7}'.format('scale', 'case', 'old (s)', 'new (s)', 'ratio'))
+    for scale in new['results']:
+        for name, r in new['results'][scale].items():
+            r_old = old['results'].get(scale, {}).get(name)
+            t_old = r_old['seconds'] if r_old else np.nan
+            ratio = r['seconds']/t_old
+            flag = 'slower' if ratio > threshold else ('faster' if ratio < 1/threshold else '')
+            print('{:>7} {:<24} {:>10.4g} {:>10.4g} {:>7.2f} {}'.format(scale, name, t_old, r['seconds'], ratio, flag))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'TRMC benchmark suite on synthetic data')
+    parser.add_argument('-s', '--scale', nargs = '+', choices = list(scales), default = list(scales))
+    parser.add_argument('-k', '--cases', nargs = '+', default = None, help = 'only cases starting with these, e.g. load fit.fit_dcs')
+    parser.add_argument('-r', '--repeats', type = int, default = 3)
+    parser.add_argument('-o', '--output', default = None, help = 'json file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD','NEW'), help = 'compare two result files instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    env = environment()
+    results = run(args.scale, args.repeats, args.cases)
+    fp = args.output or default_output(env)
+    os.makedirs(os.path.dirname(os.path.abspath(fp)), exist_ok = True)
+    with open(fp, 'w') as f:
+        json.dump({'env' : env, 'scales' : {s : scales[s] for s in args.scale}, 'results' : results}, f, indent = 1, default = float)
+    print('results written to ' + fp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Synthetic TRMC data in the formats written by the instrument
+
+freqfluence_tree - FreqFluence folders ({freq}GHz_{direction}) of trace files with a dark cavity sweep in each,
+                   for load.freqfluence_flist, load.freqdcs_flist, load.read_params and load.freqfluence_load
+sweep_tree - Sweep_{time}ms{tc}_exp.csv cavity sweeps in one folder per sample, for load.sweeps2ds
+deltav - deltaV DataArray with time and freq dims, for the color and absolute value plots
+check_headers - assert that the original header parsers and load.read_params agree on the trace files
+"""
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from trmc import analysis, load
+
+sweep_columns = 'f(Ghz), Vsignal(V),Experimental R'
+trace_columns = 'Time (s),Voltage (V),Conductance (S)'
+
+
+def trace_header(amp, back_V, filt, fluence, freq, unit = 'm', sample = 'synthetic'):
+    """the 13 header lines (key,value, rows) and the column names of a trace file, back_V in V written fixed point in mV or µV"""
+    scale = {'m' : 1e3, 'µ' : 1e6}[unit]
+    fields = [('Date', '1/28/2019'), ('Sample', sample), ('Amplification', '{:g}'.format(amp)),
+              ('Frequency', '{:.3f} GHz'.format(freq*1e-9)), ('Filter', '{:d}'.format(filt)),
+              ('Fluence', '{:g}'.format(fluence)), ('Power', '1.0'), ('K', '1.0'), ('Sweep', '1'),
+              ('Averages', '64'), ('Background Voltage', '{:.3f}{}V'.format(-back_V*scale, unit)), ('Notes', '')]
+    lines = ['Parameter,Value'] + [k + ',' + v + ',' for k, v in fields] + [trace_columns]
+    return '\n'.join(lines) + '\n'
+
+def write_trace(fp, t, v, amp, back_V, filt, fluence, freq, unit = 'm'):
+    with open(fp, 'w', encoding = 'utf-8') as f:
+        f.write(trace_header(amp, back_V, filt, fluence, freq, unit))
+        np.savetxt(f, np.column_stack([t, v, 2*v]), fmt = '%.6e', delimiter = ',')
+
+def write_sweep(fp, freq, v, R):
+    """cavity sweep csv, the f(Ghz) column holds Hz as in the instrument files"""
+    np.savetxt(fp, np.column_stack([freq, v, R]), fmt = ['%.1f','%.6e','%.6e'], delimiter = ',', header = sweep_columns, comments = '')
+
+def cavity(freq, f0, R0 = 0.2, Rinf = 0.9, w = 1e7):
+    return analysis.lor(freq, f0, R0, Rinf, w)
+
+
+def freqfluence_tree(root, freqs = (8.53e9, 8.54e9), directions = ('U','D'), fluences = (1e12, 1e13, 1e14),
+                     ntime = 1000, nsweep = 401, seed = 0):
+    """
+    Write a FreqFluence folder tree under root: a trace file per fluence and a dark cavity sweep
+    in every frequency/direction folder. Every other file has a background voltage below 1 mV, written in µV.
+
+    returns root
+    """
+    rng = np.random.default_rng(seed)
+    t = np.linspace(-50e-9, 450e-9, ntime)
+    f0 = np.mean(freqs)
+    for freq in freqs:
+        for direction in directions:
+            folder = os.path.join(root, '{:.3f}GHz_{}'.format(freq*1e-9, direction))
+            os.makedirs(folder, exist_ok = True)
+            for i, fluence in enumerate(fluences):
+                decay = np.exp(-np.clip(t, 0, None)/1e-7)*(t > 0)
+                v = -1e-4*np.log10(fluence)*decay*np.cos((freq - f0)/2e7) + rng.normal(0, 1e-5, ntime) + 1e-4
+                fn = 'Filter={}_Fluence={:g}_data.csv'.format(i, fluence)
+                unit = 'µ' if i % 2 else 'm'
+                back_V = rng.uniform(1e-4, 1e-3) if unit == 'µ' else rng.uniform(1e-3, 3e-2)
+                write_trace(os.path.join(folder, fn), t, v, 10, back_V, i, fluence, freq, unit)
+            fs = np.linspace(freq - 5e7, freq + 5e7, nsweep)
+            R = cavity(fs, freq + rng.normal(0, 1e6))
+            write_sweep(os.path.join(folder, 'FreqSweep_DarkCavitySweep_exp.csv'), fs, 0.025*R + rng.normal(0, 1e-5, nsweep), R)
+    return root
+
+def sweep_tree(root, samples = 2, swtimes = 20, tcs = ('tc0','tc1'), nfreq = 401, seed = 0):
+    """
+    Write swtimes x len(tcs) cavity sweeps for each of samples sample folders, the resonance shifting
+    and broadening with the sweep time.
+
+    returns the {sample : folder} dict for load.sweeps2ds
+    """
+    rng = np.random.default_rng(seed)
+    fs = np.linspace(8.50e9, 8.56e9, nfreq)
+    fps = {}
+    for s in range(samples):
+        samp = 'samp{}'.format(s)
+        fps[samp] = os.path.join(root, samp)
+        os.makedirs(fps[samp], exist_ok = True)
+        for k in range(swtimes):
+            for tc in tcs:
+                R = cavity(fs, 8.53e9 + 1e5*k, w = 1e7*(1 + 0.01*k))
+                fn = 'Sweep_{}ms{}_exp.csv'.format(10*k, tc)
+                write_sweep(os.path.join(fps[samp], fn), fs, 0.025*R + rng.normal(0, 1e-5, nfreq), R)
+    return fps
+
+def deltav(ntime = 1000, nfreq = 100, seed = 0):
+    """deltaV(t, w) of a shifting resonance with noise, a DataArray with time and freq dims"""
+    rng = np.random.default_rng(seed)
+    time = np.linspace(-50e-9, 450e-9, ntime)
+    freq = np.linspace(8.50e9, 8.56e9, nfreq)
+    shift = 2e6*np.exp(-np.clip(time, 0, None)/1e-7)*(time > 0)
+    z = 0.025*(cavity(freq, 8.53e9 + shift[:,np.newaxis]) - cavity(freq, 8.53e9))
+    z += rng.normal(0, 1e-5, z.shape)
+    return xr.DataArray(z, dims = ['time','freq'], coords = {'time' : time, 'freq' : freq})
+
+
+def read_params_ref(filepath):
+    """The original load.read_params (with .iloc[0], pandas no longer falls back to positions)"""
+    params = pd.read_csv(filepath, nrows = 11, usecols = [1])
+    params = params.transpose()
+    amp = float(params['Amplification'].iloc[0])
+    back_V = params['Background Voltage'].iloc[0].replace('V','')
+    unitdict = {'m':1e-3, 'u':1e-6}
+    scale = unitdict[back_V[-1]]
+    back_V = float(back_V[:len(back_V)-1])*scale
+    return amp, back_V
+
+def back_V_ref(filepath):
+    """background voltage magnitude as parsed by the original freqfluence_load"""
+    with open(filepath, encoding = 'utf-8') as p:
+        for n, line in enumerate(p):
+            if n == 11:
+                line = line.replace('Â', '')
+                m = re.search(r"^Background Voltage,-(\d+\.\d+)(.)V", line)
+                if m == None:
+                    m = re.search(r"^Background Voltage,-(\d+)(.)V", line)
+                fac = {'m' : 1e-3, 'µ' : 1e-6}[m.groups()[1]]
+                return float(m.groups()[0])*fac
+
+def check_headers(fps):
+    """assert the original parsers (read_params_ref for mV files, back_V_ref for all) agree with load.read_params"""
+    for fp in fps:
+        amp, back_V = load.read_params(fp)
+        assert np.isclose(-back_V, back_V_ref(fp), rtol = 1e-12), fp
+        if load.read_trace_file(fp, data = False)[0].back_V_unit == 'm':
+            assert np.allclose(read_params_ref(fp), (amp, back_V), rtol = 1e-12), fp
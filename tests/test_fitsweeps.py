@@ -0,0 +1,36 @@
+import numpy as np
+import xarray as xr
+
+from trmc import analysis
+
+freq = np.linspace(8.50e9, 8.56e9, 401)
+
+
+def sweeps(fn, n = 40, seed = 0, **params):
+    rng = np.random.default_rng(seed)
+    f0 = 8.53e9 + rng.normal(0, 2e6, n)
+    y = fn(freq, f0[:,np.newaxis], **params)
+    return xr.DataArray(y, dims = ['time','freq'], coords = {'time' : np.arange(n), 'freq' : freq}), f0
+
+
+def test_lorline_degenerate_and_empty_sweeps():
+    """clean lor_line sweeps (b collinear with R0 and Rinf), one all nan and one flat sweep in the batch"""
+    da, f0 = sweeps(analysis.lor_line, R0 = 0.005, Rinf = 0.02, w = 1e7, m = 0, b = 0.001)
+    da[3] = np.nan
+    da[5] = 0.01
+    ds = analysis.fitsweeps(da, fittype = 'lorline', warm_dim = None)
+
+    params = ds['params'].values
+    assert np.isnan(params[3]).all()
+    ok = np.ones(len(f0), dtype = bool)
+    ok[[3,5]] = False
+    np.testing.assert_allclose(params[ok,0], f0[ok], rtol = 1e-9)
+    np.testing.assert_allclose(ds['fits'].values[ok], da.values[ok], atol = 1e-9)
+
+
+def test_lor_unaffected_by_empty_sweep():
+    da, f0 = sweeps(analysis.lor, R0 = 0.005, Rinf = 0.02, w = 1e7)
+    da[0] = np.nan
+    ds = analysis.fitsweeps(da, fittype = 'lor')
+    assert np.isnan(ds['params'].values[0]).all()
+    np.testing.assert_allclose(ds['params'].sel(param = 'f0').values[1:], f0[1:], rtol = 1e-9)
@@ -1,3 +1,3 @@
-__all__ = ['load','kin','analysis']
+__all__ = ['load','kin','analysis','cache','live','catalog','jobs','timing']
 
 from trmc import *
\ No newline at end of file
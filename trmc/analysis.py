@@ -1,7 +1,13 @@
 import scipy.optimize
 import pandas as pd
 import numpy as np
+import xarray as xr
 import re
+import os
+import collections
+import functools
+
+from trmc import load, timing
 
 
 
@@ -11,47 +17,127 @@ def offsettime(df, timebefore = 0, timeafter = None):
     timemax = df[df.columns[0]].idxmax()
     time = df.index
     time1 = timemax-timebefore
-    idx1 = time.get_loc(time1, method = 'nearest')
+    idx1 = time.get_indexer([time1], method = 'nearest')[0]
 
     if timeafter is None:
         idx2 = -1
     else:
         time2 = timemax+timeafter
-        idx2 = time.get_loc(time2, method = 'nearest')
+        idx2 = time.get_indexer([time2], method = 'nearest')[0]
 
     df_cut = df.iloc[idx1:idx2]
     df_cut = df_cut.set_index(time[idx1:idx2] - timemax)
     return df_cut
 
-def calc_K(f0,R0_norm,w, printparams = False, coupling = 'under'):   
-    """Calculate the K value from the lorentzian fit constants""" 
+def aligntraces(traces, t = None, timebefore = 0, timeafter = None, interp = False):
+    """
+    Align many traces on their own maximum at once
+
+    traces - (N x time) array, or a DataFrame with a time index and one column per trace (like offsettime)
+    t - time array, taken from the index for a DataFrame
+    timebefore, timeafter - extent of the aligned time grid around the max. timeafter = None goes to 
+                            the end of the trace whose max is latest, other traces are nan padded.
+    interp - find the max with a parabola through the peak and its neighbours and linearly 
+             interpolate onto the grid, otherwise each trace is shifted by whole samples
+
+    returns the common aligned time grid (max at 0) and the aligned (N x grid) array
+    (or a DataFrame like the input)
+    """
+    df = None
+    if isinstance(traces, pd.DataFrame):
+        df = traces
+        t = df.index.values
+        traces = df.values.T
+    traces = np.atleast_2d(np.asarray(traces, dtype = float))
+    t = np.asarray(t, dtype = float)
+    dt = np.median(np.diff(t))
+
+    peak = np.nanargmax(np.where(np.isnan(traces), -np.inf, traces), axis = 1)
+    t_peak = t[peak]
+    if interp:
+        p = np.clip(peak, 1, len(t) - 2)
+        rows = np.arange(len(traces))
+        y1, y2, y3 = traces[rows,p-1], traces[rows,p], traces[rows,p+1]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            frac = 0.5*(y1 - y3)/(y1 - 2*y2 + y3)
+        frac = np.where(np.isfinite(frac) & (np.abs(frac) <= 1) & (p == peak), frac, 0)
+        t_peak = np.where(frac >= 0, t[p] + frac*(t[p+1] - t[p]), t[p] + frac*(t[p] - t[p-1]))
+
+    if timeafter is None:
+        timeafter = t[-1] - t_peak.min()
+    t_grid = np.arange(-int(round(timebefore/dt)), int(round(timeafter/dt)) + 1)*dt
+
+    tt = t_peak[:,np.newaxis] + t_grid
+    i = np.clip(np.searchsorted(t, tt), 1, len(t) - 1)
+    t0, t1 = t[i-1], t[i]
+    rows = np.arange(len(traces))[:,np.newaxis]
+    if interp:
+        w = (tt - t0)/(t1 - t0)
+        aligned = traces[rows,i-1]*(1-w) + traces[rows,i]*w
+    else:
+        i = np.where(tt - t0 <= t1 - tt, i-1, i)
+        aligned = traces[rows,i]
+    aligned[(tt < t[0] - dt/2) | (tt > t[-1] + dt/2)] = np.nan
+
+    if df is not None:
+        return t_grid, pd.DataFrame(aligned.T, index = t_grid, columns = df.columns)
+    return t_grid, aligned
+
+Cavity = collections.namedtuple('Cavity', ['w','h','l','eps_r'])
+Cavity.__doc__ = """Cavity geometry for calc_K, width, height and length in m and the relative permittivity"""
+default_cavity = Cavity(w = 22.86e-3, h = 10.16e-3, l = 76e-3, eps_r = 1) # length: just came up with this number
+
+@functools.lru_cache()
+def cavity_const(cavity = default_cavity):
+    """pi*eps_r*eps_0*l*beta for a cavity, computed once per geometry"""
+    eps_0 = 8.85e-12
+    beta = cavity.w/cavity.h
+    return np.pi*cavity.eps_r*eps_0*cavity.l*beta
+
+def _printparam(name, value):
+    if np.ndim(value) == 0:
+        print(name + ': ', "{:.2E}".format(float(value)))
+    else:
+        print(name + ': ', value)
+
+def _coupling_sign(coupling):
+    """+1 for over and -1 for under coupled, for a string or an array of them"""
+    if isinstance(coupling, str):
+        if coupling not in ('under','over'):
+            raise ValueError("coupling must be 'under' or 'over'")
+        return 1 if coupling == 'over' else -1
+    values = np.asarray(coupling.values if hasattr(coupling, 'dims') else coupling)
+    bad = ~np.isin(values, ['under','over'])
+    if bad.any():
+        raise ValueError("coupling must be 'under' or 'over', got " + repr(values[bad].tolist()[0]))
+    if hasattr(coupling, 'dims'):
+        return xr.where(coupling == 'over', 1, -1)
+    return np.where(values == 'over', 1, -1)
+
+def calc_K(f0,R0_norm,w, printparams = False, coupling = 'under', cavity = default_cavity):   
+    """
+    Calculate the K value from the lorentzian fit constants
+
+    f0, R0_norm, w can be numbers, arrays or xarray objects and broadcast together.
+    coupling - 'under' or 'over', or an array (or DataArray) of them giving the coupling of each element
+    cavity - a Cavity with the geometry
+    """ 
     Q = f0/w
     t_rc = Q/(np.pi*f0)
+    sign = _coupling_sign(coupling)
 
-    cav_w = 22.86e-3 #km(?)
-    cav_h = 10.16e-3 #km
-    cav_l = 76e-3 #mm  just came up with this number
+    # under: -2Q(1/sqrt(R0) - 1), over: 2Q(1/sqrt(R0) + 1)
+    K = ( 2*Q*( sign/np.sqrt(R0_norm) + 1 ) )/(f0*cavity_const(cavity))
 
-    beta = cav_w/cav_h
-    eps_r = 1 #dielectric
-    eps_0 = 8.85e-12
-    
-    if coupling == 'under':
-        K = -( 2*Q*(( (1/np.sqrt(R0_norm)) - 1 ) ) )/(np.pi*f0*eps_r*eps_0*cav_l*beta)
-    elif coupling == 'over':
-        K = ( 2*Q*(( (1/np.sqrt(R0_norm)) + 1 ) ) )/(np.pi*f0*eps_r*eps_0*cav_l*beta)
     if(printparams):
-#         print('eps: ', "{:.2E}".format(eps))
-#         print('beta: ', "{:.2E}".format(beta))
-#         print('cav_l: ', "{:.2E}".format(cav_l))
-        print('f0: ', "{:.2E}".format(f0))
-        print('w: ', "{:.2E}".format(w))
-        print('R0: ', "{:.2E}".format(R0))
+        _printparam('f0', f0)
+        _printparam('w', w)
+        _printparam('R0', R0_norm)
         print('Checks:')
-        print('Q: ', "{:.2E}".format(Q))
-        print('t_rc: ', "{:.2E}".format(t_rc))
+        _printparam('Q', Q)
+        _printparam('t_rc', t_rc)
         print('Output: ')
-        print('K: ', "{:.2E}".format(K))
+        _printparam('K', K)
     return K
 
 import itertools
@@ -68,10 +154,15 @@ def dict_product(dicts):
 
 ###Fitting###
 
+@timing.timed
 def fitsweep(v, p0, bounds, window, fittype, p_labels):
+    """Fit a single sweep, p0 = None uses the closed form guess (lor_guess) for the lorentzian fits"""
     xdata = v.indexes['freq'].values
     ydata = v.values
 
+    if p0 is None:
+        p0 = [None]*len(batch_models[fittype][2]) if fittype in batch_models else None
+
     if fittype == 'lor':
         if p0[0] == None:
             f0 = v.to_series().idxmin()
@@ -102,8 +193,20 @@ def fitsweep(v, p0, bounds, window, fittype, p_labels):
     return v_fit, v_p, v_sl
 
 
-def fit_lor_line(xdata,ydata, p0, bounds = ([0,0,0, 0, -np.inf,0],[np.inf,np.inf,np.inf,np.inf,np.inf,np.inf]), window = 105):
-    """Fits to lorentzian function and returns parameters"""
+def _fill_p0(p0, guess):
+    """replace None (or a None p0) with the closed form guess"""
+    if p0 is None:
+        return list(guess)
+    return [g if p is None else p for p, g in zip(p0, guess)]
+
+@timing.timed
+def fit_lor_line(xdata,ydata, p0 = None, bounds = ([0,0,0, 0, -np.inf,0],[np.inf,np.inf,np.inf,np.inf,np.inf,np.inf]), window = 105, jac = True):
+    """
+    Fits to lorentzian function and returns parameters
+
+    p0 - None values are filled in from lor_line_guess
+    jac - use the analytic jacobian lor_line_jac
+    """
     #xdata = sweep.index.values
     #ydata = sweep.values
 
@@ -111,7 +214,8 @@ def fit_lor_line(xdata,ydata, p0, bounds = ([0,0,0, 0, -np.inf,0],[np.inf,np.inf
     minfreq = xdata[minidx]
 
     sl = slice(minidx-window,minidx+window+1)
-    popt,popc = scipy.optimize.curve_fit(lor_line,xdata[sl],ydata[sl], p0 , bounds = bounds)
+    p0 = _fill_p0(p0, lor_line_guess(xdata[sl],ydata[sl]))
+    popt,popc = scipy.optimize.curve_fit(timing.counted(lor_line, 'analysis.fit_lor_line'),xdata[sl],ydata[sl], p0 , bounds = bounds, jac = lor_line_jac if jac else None)
     p = (popt,popc)
     return p, sl
 
@@ -124,8 +228,14 @@ def lor_line_fn(f0,R0,Rinf,w ,m,b):
         return lor_line(f,f0,R0, Rinf,w,m,b)
     return fn 
 
-def fit_lor(xdata,ydata, p0, bounds = ([0,0,0, 0],[np.inf,np.inf,np.inf,np.inf]), window = 105):
-    """Fits to lorentzian function and returns parameters"""
+@timing.timed
+def fit_lor(xdata,ydata, p0 = None, bounds = ([0,0,0, 0],[np.inf,np.inf,np.inf,np.inf]), window = 105, jac = True):
+    """
+    Fits to lorentzian function and returns parameters
+
+    p0 - None values are filled in from lor_guess
+    jac - use the analytic jacobian lor_jac
+    """
     #xdata = sweep.index.values
     #ydata = sweep.values
 
@@ -133,7 +243,8 @@ def fit_lor(xdata,ydata, p0, bounds = ([0,0,0, 0],[np.inf,np.inf,np.inf,np.inf])
     minfreq = xdata[minidx]
 
     sl = slice(minidx-window,minidx+window+1)
-    popt,popc = scipy.optimize.curve_fit(lor,xdata[sl],ydata[sl], p0 , bounds = bounds)
+    p0 = _fill_p0(p0, lor_guess(xdata[sl],ydata[sl]))
+    popt,popc = scipy.optimize.curve_fit(timing.counted(lor, 'analysis.fit_lor'),xdata[sl],ydata[sl], p0 , bounds = bounds, jac = lor_jac if jac else None)
     p = (popt,popc)
     return p, sl
 
@@ -146,9 +257,240 @@ def lorfn(f0,R0,Rinf,w ):
 def lor(f,f0,R0,Rinf, w): 
     return (R0 + Rinf*(2*(f-f0)/w)**2)/(1 + (2*(f-f0)/w)**2)
 
+def lor_jac(f,f0,R0,Rinf,w):
+    """Jacobian of lor wrt (f0,R0,Rinf,w), stacked on a new last axis. Broadcasts like lor."""
+    u = 2*(f-f0)/w
+    D = 1 + u**2
+    dy_du = 2*u*(Rinf - R0)/D**2
+    return np.stack(np.broadcast_arrays(-2*dy_du/w, 1/D, u**2/D, -dy_du*u/w), axis = -1)
 
-def fit_poly2(xdata,ydata, p0, bounds = ([0,0,0],[np.inf,np.inf,np.inf]), window = 105):
-    """Fits to a polynomial and returns fit function and parameters"""
+def lor_guess(f, y):
+    """
+    Closed form estimate of (f0,R0,Rinf,w) for lor, works along the last axis and ignores nan in y.
+
+    f0 is the vertex of the parabola through the minimum and its neighbours. With X = (f-f0)^2
+    and a = 4/w^2 the lorentzian rearranges to y = R0 + a*Rinf*X - a*X*y, which is linear in
+    (R0, a*Rinf, a) and solved by least squares.
+    """
+    f, y = np.broadcast_arrays(np.asarray(f, dtype = float), np.asarray(y, dtype = float))
+    mask = ~np.isnan(y)
+    i = np.argmin(np.where(mask, y, np.inf), axis = -1)[...,np.newaxis]
+    i = np.clip(i, 1, f.shape[-1] - 2)
+    (x1, x2, x3), (y1, y2, y3) = [[np.take_along_axis(a, i + k, axis = -1)[...,0] for k in (-1,0,1)] for a in (f, y)]
+
+    # parabola vertex relative to the middle point
+    d1, d3 = x1 - x2, x3 - x2
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        A = ((y1 - y2)*d3 - (y3 - y2)*d1)/(d1*d3*(d1 - d3))
+        B = ((y3 - y2)*d1**2 - (y1 - y2)*d3**2)/(d1*d3*(d1 - d3))
+        vertex = np.clip(-B/(2*A), d1, d3)
+    f0 = x2 + np.where(A > 0, vertex, 0)
+
+    X = (f - f0[...,np.newaxis])**2
+    D0 = np.nan_to_num(np.stack([np.ones_like(X), X, -X*y], axis = -1)*mask[...,np.newaxis])
+    y0 = np.where(mask, y, 0)
+    weight = np.ones_like(X)
+    for it in range(2):
+        # second pass weights by 1/(1+u^2) as the rearranged equation scales the noise by (1+u^2)
+        D = D0*weight[...,np.newaxis]
+        norm = np.sqrt((D**2).sum(axis = -2))
+        norm = np.where(norm > 0, norm, 1)
+        Dn = D/norm[...,np.newaxis,:]
+        rhs = np.einsum('...mi,...m->...i', Dn, y0*weight)
+        coef = np.linalg.solve(np.einsum('...mi,...mj->...ij', Dn, Dn) + 1e-12*np.eye(3), rhs[...,np.newaxis])[...,0]/norm
+        weight = 1/(1 + np.abs(coef[...,2:3])*X)
+
+    R0, c1, a = coef[...,0], coef[...,1], coef[...,2]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        w = np.where(a > 0, 2/np.sqrt(np.abs(a)), (f[...,-1] - f[...,0])/10)
+        Rinf = np.where(a > 0, c1/a, np.nanmax(y, axis = -1))
+    return np.stack([f0, R0, Rinf, w], axis = -1)
+
+def lor_line_guess(f, y):
+    """lor_guess with no line, (f0,R0,Rinf,w,m,b)"""
+    g = lor_guess(f, y)
+    return np.concatenate([g, np.zeros(g.shape[:-1] + (2,))], axis = -1)
+
+def lor_line_jac(f,f0,R0,Rinf,w,m,b):
+    """Jacobian of lor_line wrt (f0,R0,Rinf,w,m,b), stacked on a new last axis"""
+    J = lor_jac(f,f0,R0,Rinf,w)
+    J[...,0] -= m
+    df = np.broadcast_to(f - f0, J.shape[:-1])
+    return np.concatenate([J, df[...,np.newaxis], np.ones_like(df)[...,np.newaxis]], axis = -1)
+
+
+###Batched fitting###
+
+batch_models = {
+    'lor' : (lor, lor_jac, ['f0','R0','Rinf','w'], ([0,0,0,0],[np.inf,np.inf,np.inf,np.inf])),
+    'lorline' : (lor_line, lor_line_jac, ['f0','R0','Rinf','w','m','b'], ([0,0,0,0,-np.inf,0],[np.inf,np.inf,np.inf,np.inf,np.inf,np.inf])),
+}
+batch_guesses = {'lor' : lor_guess, 'lorline' : lor_line_guess}
+
+def _solve_batch(A, b):
+    """solve every A x = b of a batch, returns x and which problems were solvable (x is nan for the others)"""
+    try:
+        return np.linalg.solve(A, b), np.ones(len(A), dtype = bool)
+    except np.linalg.LinAlgError:
+        out = np.full(b.shape, np.nan)
+        ok = np.zeros(len(A), dtype = bool)
+        for i in range(len(A)):
+            try:
+                out[i] = np.linalg.solve(A[i], b[i])
+                ok[i] = True
+            except np.linalg.LinAlgError:
+                pass
+        return out, ok
+
+def _lm_batch(fn, jac, x, y, p, lb, ub, maxiter = 100, ftol = 1e-8, xtol = 1e-8, lam_min = 1e-10):
+    """
+    Levenberg-Marquardt on a batch of independent problems at once.
+
+    x, y are (batch, points) with nan in y for points to ignore, p is (batch, params).
+    The parameters are clipped to the bounds after each step. lam_min keeps the damped normal
+    equations solvable when parameters are degenerate (b vs R0 and Rinf of lor_line on a flat sweep).
+    Problems with no points, no finite start or a singular step get nan parameters, the rest are unaffected.
+
+    returns p, the parameter covariances (batch, params, params), cost and number of iterations
+    """
+    mask = ~np.isnan(y)
+    y = np.where(mask, y, 0)
+    args = lambda p: [p[:,i:i+1] for i in range(p.shape[1])]
+
+    def residuals(sel, p):
+        return np.where(mask[sel], fn(x[sel], *args(p)) - y[sel], 0)
+
+    failed = ~mask.any(axis = 1) | ~np.isfinite(p).all(axis = 1)
+    p = np.where(failed[:,np.newaxis], np.nan, p)
+    r = np.zeros(y.shape)
+    r[~failed] = residuals(~failed, p[~failed])
+    cost = (r**2).sum(axis = 1)
+    lam = np.full(len(p), 1e-3)
+    active = ~failed
+    eye = np.eye(p.shape[1])
+
+    for it in range(maxiter):
+        if not active.any():
+            break
+        pa = p[active]
+        J = jac(x[active], *args(pa))*mask[active][...,np.newaxis]
+        A = np.einsum('bmi,bmj->bij', J, J)
+        g = np.einsum('bmi,bm->bi', J, r[active])
+
+        # solve with the jacobian columns normalized so badly scaled parameters (f0 vs R0) don't matter
+        d = np.sqrt(np.diagonal(A, axis1 = 1, axis2 = 2))
+        d = np.where(d > 0, d, 1)
+        A_s = A/(d[:,:,np.newaxis]*d[:,np.newaxis,:]) + lam[active][:,np.newaxis,np.newaxis]*eye
+        step, solved = _solve_batch(A_s, (g/d)[...,np.newaxis])
+        step = -step[...,0]/d
+
+        p_new = np.clip(pa + np.where(solved[:,np.newaxis], step, 0), lb, ub)
+        r_new = residuals(active, p_new)
+        cost_new = (r_new**2).sum(axis = 1)
+
+        idx = np.flatnonzero(active)
+        failed[idx[~solved]] = True
+        better = (cost_new < cost[active]) & solved
+        small_step = (np.abs(p_new - pa) <= xtol*(np.abs(pa) + xtol)).all(axis = 1)
+        done = better & (((cost[active] - cost_new) <= ftol*cost[active]) | small_step)
+        done |= ~better & (lam[active] > 1e10)
+        done |= ~solved
+
+        p[idx[better]] = p_new[better]
+        r[idx[better]] = r_new[better]
+        cost[idx[better]] = cost_new[better]
+        lam[idx] = np.where(better, np.maximum(lam[active]/10, lam_min), lam[active]*10)
+        active[idx[done]] = False
+
+    p[failed] = np.nan
+    cost[failed] = np.nan
+    pcov = np.full(p.shape + (p.shape[1],), np.nan)
+    ok = ~failed
+    J = jac(x[ok], *args(p[ok]))*mask[ok][...,np.newaxis]
+    A = np.einsum('bmi,bmj->bij', J, J)
+    d = np.sqrt(np.diagonal(A, axis1 = 1, axis2 = 2))
+    d = np.where(d > 0, d, 1)
+    dof = np.maximum(mask[ok].sum(axis = 1) - p.shape[1], 1)
+    if ok.any():
+        pcov[ok] = np.linalg.pinv(A/(d[:,:,np.newaxis]*d[:,np.newaxis,:]))/(d[:,:,np.newaxis]*d[:,np.newaxis,:])
+        pcov[ok] *= (cost[ok]/dof)[:,np.newaxis,np.newaxis]
+    return p, pcov, cost, it + 1
+
+def fitsweeps(da, p0 = None, bounds = None, window = 105, fittype = 'lor', warm_dim = 'time', maxiter = 100):
+    """
+    Fit lor or lor_line to every frequency sweep in a DataArray at once
+
+    da - DataArray with a freq dim, e.g. (sample, time, freq)
+    p0 - initial parameters as in fitsweep, None values come from the closed form guess of each sweep
+    window - points either side of the minimum of each sweep used in the fit
+    warm_dim - fits are done one value of this dim at a time (all other dims at once),
+               each starting from the results of the previous one. None fits everything at once from p0.
+
+    returns a Dataset with the fit parameters and errors (with a param dim), their covariance (param, param_)
+    and the fits evaluated on the freq grid
+    """
+    fn, jac, p_labels, default_bounds = batch_models[fittype]
+    lb, ub = [np.asarray(b, dtype = float) for b in (bounds if bounds is not None else default_bounds)]
+
+    if warm_dim is None:
+        warm_dim = '_all'
+    if warm_dim not in da.dims:
+        da = da.expand_dims(warm_dim)
+        squeeze = True
+    else:
+        squeeze = False
+    other = [dim for dim in da.dims if dim not in ('freq', warm_dim)]
+    da = da.transpose(warm_dim, *other, 'freq')
+    freq = da.indexes['freq'].values
+    vals = da.values.reshape(da.shape[0], -1, len(freq))
+
+    offsets = np.arange(-window, window + 1)
+    params = np.empty(vals.shape[:2] + (len(p_labels),))
+    perr = np.empty_like(params)
+    pcovs = np.empty(params.shape + (len(p_labels),))
+    p = None
+    p_start = np.array([np.nan if v is None else v for v in (p0 if p0 is not None else [None]*len(p_labels))], dtype = float)
+    for i, y_all in enumerate(vals):
+        empty = np.isnan(y_all).all(axis = 1)
+        minidx = np.where(empty, 0, np.argmin(np.where(np.isnan(y_all), np.inf, y_all), axis = 1))
+        idx = minidx[:,np.newaxis] + offsets
+        inside = (idx >= 0) & (idx < len(freq))
+        idx = np.clip(idx, 0, len(freq) - 1)
+        x = freq[idx]
+        y = np.where(inside, np.take_along_axis(y_all, idx, axis = 1), np.nan)
+
+        guess = batch_guesses[fittype](x, y)
+        if p is None:
+            p = np.where(np.isnan(p_start), guess, p_start)
+        if np.isnan(p_start[0]):
+            # f0 starts at the minimum of each sweep, only the shape is warm started
+            p[:,0] = guess[:,0]
+        p = np.clip(np.where(np.isnan(p), guess, p), lb, ub)
+
+        p, pcov, cost, nit = _lm_batch(fn, jac, x, y, p, lb, ub, maxiter = maxiter)
+        params[i] = np.where(empty[:,np.newaxis], np.nan, p)
+        perr[i] = np.sqrt(np.diagonal(pcov, axis1 = 1, axis2 = 2))
+        perr[i][empty] = np.nan
+        pcovs[i] = np.where(empty[:,np.newaxis,np.newaxis], np.nan, pcov)
+
+    shape = da.shape[:-1]
+    coords = {dim : da.coords[dim] for dim in da.dims if dim != 'freq' and dim in da.coords}
+    dims = [warm_dim, *other, 'param']
+    params = xr.DataArray(params.reshape(*shape, -1), dims = dims, coords = dict(coords, param = p_labels))
+    perr = xr.DataArray(perr.reshape(*shape, -1), dims = dims, coords = dict(coords, param = p_labels))
+    pcovs = xr.DataArray(pcovs.reshape(*shape, len(p_labels), -1), dims = dims + ['param_'], coords = dict(coords, param = p_labels, param_ = p_labels))
+    fits = fn(freq, *[params.sel(param = name).values[...,np.newaxis] for name in p_labels])
+    fits = xr.DataArray(fits, dims = da.dims, coords = da.coords)
+
+    ds = xr.Dataset({'params' : params, 'perr' : perr, 'pcov' : pcovs, 'fits' : fits})
+    if squeeze:
+        ds = ds.squeeze(warm_dim, drop = True)
+    return ds
+
+
+@timing.timed
+def fit_poly2(xdata,ydata, p0, bounds = ([0,0,0],[np.inf,np.inf,np.inf]), window = 105, jac = True):
+    """Fits to a polynomial and returns fit function and parameters, jac uses the analytic jacobian poly2_jac"""
     # xdata = sweep.index.values
     # ydata = sweep.values
 
@@ -157,7 +499,7 @@ def fit_poly2(xdata,ydata, p0, bounds = ([0,0,0],[np.inf,np.inf,np.inf]), window
 
     sl = slice(minidx-window,minidx+window)
 
-    popt,popc = scipy.optimize.curve_fit(poly2,xdata[sl],ydata[sl], p0 , bounds = bounds)
+    popt,popc = scipy.optimize.curve_fit(timing.counted(poly2, 'analysis.fit_poly2'),xdata[sl],ydata[sl], p0 , bounds = bounds, jac = poly2_jac if jac else None)
     p = (popt,popc)
     return p, sl
 
@@ -168,6 +510,11 @@ def poly2fn(c0,c1,c2):
 
 def poly2(x,c0,c1,c2):
     return c0 + c1*x + c2*x**2
+
+def poly2_jac(x,c0,c1,c2):
+    """Jacobian of poly2 wrt (c0,c1,c2)"""
+    x = np.asarray(x, dtype = float)
+    return np.stack([np.ones_like(x), x, x**2], axis = -1)
     
 
 
@@ -199,6 +546,130 @@ def polymin(v0,v0_sl, fit):
 
 
 
+###Dark cavity sweep pipeline###
+
+def _fit_dcs_file(fp, p0, bounds, window, fittype, coupling):
+    """Load and fit one dark cavity sweep, errors are returned rather than raised"""
+    try:
+        s = load.loadsweep(fp)
+        s.index = s.index.rename('freq')
+        v = xr.DataArray.from_series(s)
+
+        v_fit, v_p, v_sl = fitsweep(v, None if p0 is None else list(p0), bounds, window, fittype, None)
+        popt, pcov = v_p
+        row = {'p' : popt[:4], 'pcov' : pcov[:4,:4], 'error' : None}
+    except Exception as e:
+        row = {'error' : repr(e)}
+    return row
+
+def fit_dcs(s_fps, p0 = None, bounds = None, window = 105, fittype = 'lor', coupling = 'under', workers = None):
+    """
+    Fit every dark cavity sweep from load.freqdcs_flist on a process pool and calculate K
+
+    p0, bounds, window, fittype - passed to fitsweep ('lor' or 'lorline'), p0 = None uses lor_guess,
+                                  bounds = None uses the bounds of the model in batch_models
+    workers - number of processes, 1 fits in this process
+
+    returns a DataFrame indexed like s_fps with f0, R0, Rinf, w, Q, K, their errors and
+    an error column holding the exception for sweeps that failed
+    """
+    if fittype not in batch_models:
+        raise ValueError('fittype must be one of ' + str(list(batch_models)))
+    if bounds is None:
+        bounds = batch_models[fittype][3]
+    args = (p0, bounds, window, fittype, coupling)
+
+    if workers == 1:
+        rows = [_fit_dcs_file(fp, *args) for fp in s_fps.values]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as ex:
+            futures = [ex.submit(_fit_dcs_file, fp, *args) for fp in s_fps.values]
+            rows = []
+            for future in futures:
+                try:
+                    rows.append(future.result())
+                except Exception as e:
+                    rows.append({'error' : repr(e)})
+
+    # K, Q and all the errors in one vectorized pass over the sweeps
+    ok = [row['error'] is None for row in rows]
+    p = np.full((len(rows), 4), np.nan)
+    pcov = np.full((len(rows), 4, 4), np.nan)
+    if any(ok):
+        p[ok] = [row['p'] for row, good in zip(rows, ok) if good]
+        pcov[ok] = [row['pcov'] for row, good in zip(rows, ok) if good]
+    df = pd.DataFrame(p, index = s_fps.index, columns = ['f0','R0','Rinf','w'])
+    Q, Q_err, K, K_err = calc_K_err(*p.T, pcov, coupling = coupling)
+    df['Q'], df['K'] = Q, K
+    for i, name in enumerate(['f0','R0','Rinf','w']):
+        df[name + '_err'] = np.sqrt(pcov[:,i,i])
+    df['Q_err'], df['K_err'] = Q_err, K_err
+    df['error'] = [row['error'] for row in rows]
+    return df
+
+
+###Uncertainty propagation###
+# Linear propagation with analytic gradients, batched over any number of leading dims.
+
+def propagate(grad, pcov):
+    """
+    Standard error of a function from its gradient (..., n) and the covariance of its arguments (..., n, n)
+    """
+    grad = np.asarray(grad, dtype = float)
+    return np.sqrt(np.einsum('...i,...ij,...j->...', grad, np.asarray(pcov, dtype = float), grad))
+
+def calc_K_err(f0, R0, Rinf, w, pcov, coupling = 'under', cavity = default_cavity):
+    """
+    Q and K of lorentzian fits with their errors
+
+    f0, R0, Rinf, w - arrays of fit parameters, R0 is normalized by Rinf for K
+    pcov - covariance of (f0, R0, Rinf, w), shape (..., 4, 4)
+
+    returns Q, Q_err, K, K_err
+    """
+    f0, R0, Rinf, w = [np.asarray(x, dtype = float) for x in (f0, R0, Rinf, w)]
+    sign = np.asarray(_coupling_sign(coupling))
+    R0_norm = R0/Rinf
+    c = cavity_const(cavity)
+
+    Q = f0/w
+    # K = 2Q(sign/sqrt(R0_norm) + 1)/(f0 c) = 2(sign/sqrt(R0_norm) + 1)/(w c)
+    K = calc_K(f0, R0_norm, w, coupling = coupling, cavity = cavity)
+    dK_dR0_norm = -sign*R0_norm**-1.5/(w*c)
+    zero = np.zeros(np.broadcast(f0, R0, Rinf, w).shape)
+
+    grad_Q = np.stack(np.broadcast_arrays(1/w, zero, zero, -f0/w**2), axis = -1)
+    grad_K = np.stack(np.broadcast_arrays(zero, dK_dR0_norm/Rinf, -dK_dR0_norm*R0/Rinf**2, -K/w), axis = -1)
+    return Q, propagate(grad_Q, pcov), K, propagate(grad_K, pcov)
+
+def fitsweeps_K_err(ds, coupling = 'under', cavity = default_cavity):
+    """Q, K and their errors for every sweep in the Dataset from fitsweeps, as a Dataset"""
+    names = ['f0','R0','Rinf','w']
+    p = ds['params'].sel(param = names)
+    pcov = ds['pcov'].sel(param = names, param_ = names).transpose(*p.dims, 'param_')
+    out = calc_K_err(*[p.sel(param = name).values for name in names], pcov.values, coupling = coupling, cavity = cavity)
+    coords = {dim : p.coords[dim] for dim in p.dims if dim != 'param' and dim in p.coords}
+    dims = [dim for dim in p.dims if dim != 'param']
+    return xr.Dataset({name : (dims, v) for name, v in zip(['Q','Q_err','K','K_err'], out)}, coords = coords)
+
+def cond_err(df_V, back_V, K, V_err = 0, back_V_err = 0, K_err = 0):
+    """
+    Error of convert_V2cond(df_V, back_V, K) from independent errors in the voltage, background voltage and K.
+    All arguments broadcast (DataFrames, Series, arrays or numbers).
+    """
+    cond = convert_V2cond(df_V, back_V, K)
+    return np.sqrt((V_err/(back_V*K))**2 + (cond*back_V_err/back_V)**2 + (cond*K_err/K)**2)
+
+def maxG_and_fom_err(df_cond, df_cond_err, params):
+    """Errors of maxG and the figure of merit from maxG_and_fom, the deltaG error is taken at the max of each column"""
+    idx = np.nanargmax(df_cond.values, axis = 0)
+    maxG_err = pd.Series(np.take_along_axis(np.asarray(df_cond_err, dtype = float)*np.ones(df_cond.shape), idx[np.newaxis], axis = 0)[0],
+                         index = df_cond.columns)
+    fom_err = _fom(maxG_err, np.asarray(df_cond.columns, dtype = float), params)
+    return maxG_err, fom_err
+
+
 ###CONVENTIONAL ANALYSIS###
 
 
@@ -206,19 +677,110 @@ def convert_V2cond(df_V,back_V,K):
     df_cond = - ((df_V)/back_V)/K
     return df_cond
 
-def maxG_and_fom(df_cond, params):
-    """Calculates maxG and the figure of merit from a dataframe of the deltaG"""
+def _fom(maxG, fluence, params):
+    """figure of merit from the max deltaG at a fluence"""
     beta = params['beta']
     e = 1.6e-19
     FA = params['FA']*0.9 #0.9 factor from ITO
     M = params['M']
+    return maxG/(beta*e*fluence*FA*M)
 
+def maxG_and_fom(df_cond, params):
+    """Calculates maxG and the figure of merit from a dataframe of the deltaG"""
     fluences = df_cond.columns
-    maxG = pd.Series(index = fluences)
-    fom = pd.Series(index = fluences)
+    maxG = df_cond.max()
+    fom = _fom(maxG, np.asarray(fluences, dtype = float), params)
+    return maxG, fom
 
-    for fluence in fluences:
-        maxG[fluence] = df_cond[fluence].max()
-        fom[fluence] =  maxG[fluence]/(beta*e*fluence*FA*M)
 
-    return maxG, fom
+###Streaming analysis###
+# Generators that take traces from disk to deltaG and figure of merit one trace
+# at a time, so memory use does not depend on the number of traces.
+
+def iter_traces(s_fps, offsettime = 50e-9, cache_dir = None):
+    """
+    Yield (key, volt, back_V) for every file of a freqfluence_flist Series, one file at a time.
+    Traces are grouped by (direction, freq) with fluence ascending, volt is an offset corrected Series.
+    """
+    for key, fp in s_fps.sort_index().items():
+        header, data = load.read_trace_file(fp, cache_dir = cache_dir)
+        volt = load._trace_series(header, data, offsettime)
+        yield key, volt, -header.back_V
+
+def stream_sub_lowpow(traces):
+    """Subtract the lowest fluence trace of each (direction, freq) from the traces in that group"""
+    group, lp = None, None
+    for key, volt, back_V in traces:
+        if key[:2] != group:
+            group, lp = key[:2], volt
+        yield key, volt - lp.values, back_V
+
+def stream_cond(traces, K, K_err = 0, back_V_err = 0, noise_window = None):
+    """
+    Convert voltage traces to deltaG with convert_V2cond
+
+    K, K_err - a number or anything indexed by (direction, freq), such as the K and K_err columns of fit_dcs
+    back_V_err - error of the background voltage
+    noise_window - (start, stop) time of the baseline, the std of deltaG there is the noise of every point
+
+    yields key, deltaG and (noise, rel_err), rel_err being the relative error from K and the background voltage
+    """
+    for key, volt, back_V in traces:
+        K_trace = K if np.isscalar(K) else K[key[:2]]
+        K_err_trace = K_err if np.isscalar(K_err) else K_err[key[:2]]
+        cond = convert_V2cond(volt, back_V, K_trace)
+        noise = 0
+        if noise_window is not None:
+            base = cond.loc[noise_window[0]:noise_window[1]]
+            noise = base.std() if len(base) > 1 else 0
+        rel_err = np.sqrt((K_err_trace/K_trace)**2 + (back_V_err/back_V)**2)
+        yield key, cond, (noise, rel_err)
+
+def stream_maxG_fom(conds, params):
+    """Yield a row dict with maxG, the time of the max and the figure of merit (with errors) for every deltaG trace"""
+    for key, cond, (noise, rel_err) in conds:
+        direction, freq, fluence = key[:3]
+        maxG = cond.max()
+        maxG_err = np.sqrt(noise**2 + (maxG*rel_err)**2)
+        yield {'direction' : direction, 'freq' : freq, 'fluence' : fluence, 'maxG' : maxG, 'maxG_err' : maxG_err,
+               'maxG_time' : cond.idxmax(), 'fom' : _fom(maxG, fluence, params), 'fom_err' : _fom(maxG_err, fluence, params)}
+
+def write_rows(rows, filepath, chunksize = 100, append = False):
+    """
+    Write row dicts to a csv every chunksize rows, returns the number of rows written
+
+    append - add the rows to an existing file (the header is written only if it doesn't exist),
+             otherwise the file is overwritten
+    """
+    n = 0
+    chunk = []
+    header = not (append and os.path.exists(filepath))
+    mode = 'a' if append else 'w'
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunksize:
+            pd.DataFrame(chunk).to_csv(filepath, mode = mode, header = header, index = False)
+            header, mode, n, chunk = False, 'a', n + len(chunk), []
+    if chunk or mode == 'w':
+        pd.DataFrame(chunk).to_csv(filepath, mode = mode, header = header, index = False)
+        n += len(chunk)
+    return n
+
+def cond_pipeline(s_fps, K, params, filepath = None, sub_lowpow = True, offsettime = 50e-9, cache_dir = None, K_err = 0, back_V_err = 0):
+    """
+    Stream every trace in a freqfluence_flist Series through offset, low power subtraction,
+    conversion to deltaG and maxG/figure of merit.
+
+    filepath - the rows are written to this csv (overwriting it) as they are produced, if None a DataFrame is returned
+    K_err, back_V_err - errors propagated to maxG_err and fom_err along with the baseline noise
+                        (the std of deltaG before offsettime)
+    """
+    traces = iter_traces(s_fps, offsettime = offsettime, cache_dir = cache_dir)
+    if sub_lowpow:
+        traces = stream_sub_lowpow(traces)
+    noise_window = (0, offsettime) if offsettime is not None else None
+    rows = stream_maxG_fom(stream_cond(traces, K, K_err, back_V_err, noise_window), params)
+
+    if filepath is None:
+        return pd.DataFrame(list(rows)).set_index(['direction','freq','fluence'])
+    return write_rows(rows, filepath)
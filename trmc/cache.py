@@ -0,0 +1,73 @@
+"""
+On disk cache of parsed data
+
+Entries are folders in a cache directory holding a meta.json and one .npy file
+per array, so arrays are memory mapped when read back. Entries for data files
+are keyed on the path, modification time and size of the file so changed files
+are parsed again and unchanged files never are.
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def file_key(filepath, tag = ''):
+    """Cache key of a file from its absolute path, mtime and size"""
+    st = os.stat(filepath)
+    s = '|'.join([tag, os.path.abspath(filepath), str(st.st_mtime_ns), str(st.st_size)])
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+def combine_keys(keys, tag = ''):
+    """Single key for a collection of keys, e.g. every file going into a dataset"""
+    h = hashlib.sha1(tag.encode('utf-8'))
+    for key in keys:
+        h.update(key.encode('utf-8'))
+    return h.hexdigest()
+
+def load(cache_dir, key, mmap_mode = 'r'):
+    """returns (meta, dict of arrays) for a key or None if it is not cached"""
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, 'meta.json'), encoding = 'utf-8') as f:
+            meta = json.load(f)
+        arrays = {name : np.load(os.path.join(entry, name + '.npy'), mmap_mode = mmap_mode) for name in meta.pop('_arrays')}
+    except (OSError, ValueError, KeyError):
+        return None
+    return meta, arrays
+
+def store(cache_dir, key, meta, **arrays):
+    """Store json-able meta and arrays under a key, written to a temporary folder and moved so entries are never partial"""
+    os.makedirs(cache_dir, exist_ok = True)
+    entry = os.path.join(cache_dir, key)
+    tmp = tempfile.mkdtemp(dir = cache_dir, prefix = '.tmp_')
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(arr))
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding = 'utf-8') as f:
+            json.dump(dict(meta, _arrays = list(arrays)), f)
+        os.replace(tmp, entry)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp, ignore_errors = True)
+
+def cached_parse(filepath, parse, cache_dir, tag = ''):
+    """
+    Parse a file through the cache
+
+    parse(filepath) must return (meta, dict of arrays) with json-able meta
+    """
+    key = file_key(filepath, tag)
+    entry = load(cache_dir, key)
+    if entry is None:
+        entry = parse(filepath)
+        store(cache_dir, key, entry[0], **entry[1])
+    return entry
+
+def clear(cache_dir):
+    """Remove every entry in a cache directory"""
+    for name in os.listdir(cache_dir):
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors = True)
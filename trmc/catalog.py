@@ -0,0 +1,182 @@
+"""
+Persistent catalog of data files and the metadata in their paths
+"""
+import os
+import re
+import sqlite3
+
+import pandas as pd
+
+
+folder_re = re.compile(r'^(\d+\.\d+)GHz_(.+?)')
+trace_re = re.compile(r'.*Filter=(\d+)_Fluence=(.+?)_data.csv')
+sweep_re = re.compile(r'Sweep_(\d+)ms(.+)exp.csv')
+dcs_name = 'FreqSweep_DarkCavitySweep_exp.csv'
+
+columns = ['path','dir','root','name','kind','sample','freq','direction','filter','fluence','swtime','tc','mtime','size']
+float_columns = ['freq','filter','fluence','swtime']
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, dir TEXT, root TEXT, name TEXT, kind TEXT, sample TEXT,
+    freq REAL, direction TEXT, filter REAL, fluence REAL, swtime REAL, tc TEXT,
+    mtime INTEGER, size INTEGER);
+CREATE INDEX IF NOT EXISTS files_sample_freq ON files (sample, freq);
+CREATE INDEX IF NOT EXISTS files_root_kind ON files (root, kind);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER);
+"""
+
+
+def infer_sample(d):
+    """sample of the files in folder d, the folder holding FreqFluence (or the {freq}GHz_{direction} folders), else d"""
+    if folder_re.search(os.path.basename(d)) is not None:
+        d = os.path.dirname(d)
+    if os.path.basename(d) == 'FreqFluence':
+        d = os.path.dirname(d)
+    return os.path.basename(d)
+
+def parse_path(path, sample = None):
+    """Metadata dict for a file from its name and folder, kind is None for files that aren't data. sample defaults to infer_sample."""
+    d, name = os.path.split(path)
+    row = {'path' : path, 'dir' : d, 'root' : d, 'name' : name, 'kind' : None,
+           'sample' : sample if sample is not None else infer_sample(d)}
+
+    m_folder = folder_re.search(os.path.basename(d))
+    if m_folder is not None:
+        row['root'] = os.path.dirname(d)
+        row['freq'] = float(m_folder.groups()[0])*1e9
+        row['direction'] = m_folder.groups()[1]
+        m = trace_re.search(name)
+        if m is not None:
+            row['kind'] = 'trace'
+            row['filter'], row['fluence'] = float(m.groups()[0]), float(m.groups()[1])
+        elif name == dcs_name:
+            row['kind'] = 'dcs'
+
+    if row['kind'] is None:
+        m = sweep_re.search(name)
+        if m is not None:
+            row['kind'] = 'sweep'
+            row['swtime'], row['tc'] = float(m.groups()[0]), m.groups()[1]
+    return row
+
+
+class Catalog():
+    """
+    SQLite catalog of TRMC data files with the sample, freq, direction, filter, fluence, 
+    sweep time and tc parsed from their paths. Other files are catalogued with kind None.
+
+    update() only lists folders whose modification time changed since the last update, so
+    keeping the catalog current on a network share costs one stat per folder.
+
+    >>> cat = Catalog('catalog.db')
+    >>> cat.update(sampledir)
+    >>> cat.query(sample = 'Bi_A_2', freq = 8.53e9, kind = 'trace')
+    """
+    def __init__(self, dbpath = ':memory:'):
+        self.con = sqlite3.connect(dbpath)
+        self.con.executescript(schema)
+
+    def close(self):
+        self.con.close()
+
+    def update(self, direc, sample = None):
+        """
+        Bring the catalog up to date for everything below direc. 
+        sample - label every file below direc with it, by default each file's sample comes from its
+                 own folder (see infer_sample), so direc can hold several samples
+        returns the number of files added or changed
+        """
+        direc = os.path.abspath(direc)
+
+        n = 0
+        stack = [(direc, os.path.dirname(direc))]
+        with self.con:
+            while stack:
+                d, parent = stack.pop()
+                try:
+                    mtime = os.stat(d).st_mtime_ns
+                except FileNotFoundError:
+                    self._remove_dir(d)
+                    continue
+                known = self.con.execute('SELECT mtime FROM dirs WHERE path = ?', (d,)).fetchone()
+                if known is not None and known[0] == mtime:
+                    subdirs = [r[0] for r in self.con.execute('SELECT path FROM dirs WHERE parent = ?', (d,))]
+                    stack.extend((sub, d) for sub in subdirs)
+                    continue
+
+                n += self._scan_dir(d, sample, stack)
+                self.con.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)', (d, parent, mtime))
+            if sample is not None:
+                self.con.execute('UPDATE files SET sample = ? WHERE dir = ? OR dir LIKE ?', (sample, direc, direc + os.sep + '%'))
+        return n
+
+    def _scan_dir(self, d, sample, stack):
+        """list one folder into the catalog, queueing its subfolders"""
+        present = set()
+        n = 0
+        old = {r[0] : (r[1], r[2]) for r in self.con.execute('SELECT path, mtime, size FROM files WHERE dir = ?', (d,))}
+        for entry in os.scandir(d):
+            if entry.is_dir():
+                stack.append((entry.path, d))
+                continue
+            st = entry.stat()
+            present.add(entry.path)
+            if old.get(entry.path) == (st.st_mtime_ns, st.st_size):
+                continue
+            row = parse_path(entry.path, sample)
+            row['mtime'], row['size'] = st.st_mtime_ns, st.st_size
+            self.con.execute('INSERT OR REPLACE INTO files VALUES (' + ','.join('?'*len(columns)) + ')',
+                             [row.get(c) for c in columns])
+            n += 1
+        for path in set(old) - present:
+            self.con.execute('DELETE FROM files WHERE path = ?', (path,))
+        for sub in [r[0] for r in self.con.execute('SELECT path FROM dirs WHERE parent = ?', (d,))]:
+            if not os.path.isdir(sub):
+                self._remove_dir(sub)
+        return n
+
+    def _remove_dir(self, d):
+        self.con.execute('DELETE FROM files WHERE dir = ? OR dir LIKE ?', (d, d + os.sep + '%'))
+        self.con.execute('DELETE FROM dirs WHERE path = ? OR path LIKE ?', (d, d + os.sep + '%'))
+
+    def query(self, **filters):
+        """
+        DataFrame of the catalogued files matching every filter, e.g. query(sample = 'X', freq = 8.53e9, kind = 'trace').
+        Float columns (freq, filter, fluence, swtime) match to a relative tolerance of 1e-9.
+        """
+        where, args = [], []
+        for col, value in filters.items():
+            if col not in columns:
+                raise ValueError('unknown column ' + col)
+            if col in float_columns:
+                where.append('ABS({0} - ?) <= 1e-9*ABS(?)'.format(col))
+                args += [value, value]
+            else:
+                where.append(col + ' = ?')
+                args.append(value)
+        sql = 'SELECT * FROM files' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY path'
+        return pd.read_sql_query(sql, self.con, params = args)
+
+    def freqfluence_flist(self, direc, sample = None):
+        """Same Series as load.freqfluence_flist, from the catalog"""
+        direc = os.path.abspath(direc)
+        self.update(direc, sample)
+        df = self.query(root = direc, kind = 'trace')
+        mi = pd.MultiIndex.from_arrays([df['direction'], df['freq'], df['fluence']], names = ['direction','freq','fluence'])
+        return pd.Series(df['path'].values, index = mi)
+
+    def freqdcs_flist(self, direc, sample = None):
+        """Same Series as load.freqdcs_flist, from the catalog"""
+        direc = os.path.abspath(direc)
+        self.update(direc, sample)
+        df = self.query(root = direc, kind = 'dcs')
+        mi = pd.MultiIndex.from_arrays([df['direction'], df['freq']], names = ['direction','freq'])
+        return pd.Series(df['path'].values, index = mi)
+
+    def listdir(self, direc, sample = None):
+        """names of the files in direc, os.listdir without the folders"""
+        direc = os.path.abspath(direc)
+        self.update(direc, sample)
+        return [r[0] for r in self.con.execute('SELECT name FROM files WHERE dir = ? ORDER BY name', (direc,))]
@@ -0,0 +1,231 @@
+"""
+Restartable fitting of V_bg(w) + deltaV(w) at every time point
+
+The time points are fitted with analysis.fitsweep in chunks on a process pool in a background
+thread. Every finished chunk is written to a checkpoint folder (through trmc.cache) so a run that
+is interrupted, or a kernel that crashes, picks up where it stopped when started again with the
+same checkpoint folder.
+
+>>> job = SweepFitJob(dvs, v0, 'checkpoints/sampleA')
+>>> job.start()
+>>> job.progress()
+>>> dst = job.result() # blocks until done, a Dataset with dvs, vss and fits for plot.sweepfitanim
+"""
+import hashlib
+import json
+import threading
+import time
+import concurrent.futures
+
+import numpy as np
+import xarray as xr
+
+from trmc import analysis, cache
+
+
+poly_bounds = ([0,0,0],[np.inf,np.inf,np.inf]) # fit_poly2's
+
+def _labels(fittype):
+    if fittype in analysis.batch_models:
+        return analysis.batch_models[fittype][2]
+    return ['minf','minR','c0','c1','c2']
+
+def _bounds(fittype):
+    """default bounds of the parameters fitsweep fits for fittype"""
+    if fittype in analysis.batch_models:
+        return analysis.batch_models[fittype][3]
+    if fittype == 'poly':
+        return poly_bounds
+    raise ValueError('fittype must be one of ' + str(list(analysis.batch_models) + ['poly']))
+
+def _fit_chunk(freq, vals, p0, bounds, window, fittype):
+    """
+    fit every sweep (row) of vals, returns fits, params and errors with nan for sweeps whose fit
+    did not converge. Other errors (bad p0 or bounds) are raised.
+    """
+    npar = len(_labels(fittype))
+    fits = np.full(vals.shape, np.nan)
+    params = np.full((len(vals), npar), np.nan)
+    perr = np.full((len(vals), npar), np.nan)
+    for i, y in enumerate(vals):
+        if np.isnan(y).all():
+            continue
+        v = xr.DataArray(y, dims = ['freq'], coords = {'freq' : freq})
+        try:
+            v_fit, v_p, v_sl = analysis.fitsweep(v, None if p0 is None else list(p0), bounds, window, fittype, None)
+        except (RuntimeError, np.linalg.LinAlgError):
+            continue
+        fits[i] = v_fit(freq)
+        params[i] = v_p[0]
+        perr[i, -len(v_p[1]):] = np.sqrt(np.diag(v_p[1]))
+    return fits, params, perr
+
+
+class SweepFitJob():
+    """
+    Fit V_bg(w) + deltaV(w) at every time with analysis.fitsweep, checkpointing each chunk of times
+
+    dvs - DataArray of deltaV with time and freq dims
+    v0 - V_bg(w), a DataArray or Series over the same freqs (None fits dvs as is)
+    checkpoint_dir - folder for the checkpoints, reusing it resumes the job
+    p0, bounds, window, fittype - passed to fitsweep, bounds = None uses the bounds of the model
+    workers - number of processes, 1 fits in the background thread itself
+    chunksize - number of time points per task and checkpoint
+    """
+    def __init__(self, dvs, v0, checkpoint_dir, p0 = None, bounds = None,
+                 window = 105, fittype = 'lor', workers = None, chunksize = 20):
+        self.dvs = dvs.transpose('time','freq')
+        if v0 is not None:
+            freq = self.dvs.indexes['freq']
+            if hasattr(v0, 'dims'):
+                v0 = v0.to_series()
+            if hasattr(v0, 'index'):
+                v0 = v0.reindex(freq, method = 'nearest')
+            v0 = xr.DataArray(np.asarray(v0, dtype = float), dims = ['freq'], coords = {'freq' : freq})
+            self.vss = self.dvs + v0
+        else:
+            self.vss = self.dvs
+        self.v0 = v0
+        self.checkpoint_dir = checkpoint_dir
+        npar = len(_bounds(fittype)[0])
+        if bounds is None:
+            bounds = _bounds(fittype)
+        elif len(bounds[0]) != npar or len(bounds[1]) != npar:
+            raise ValueError('bounds must have {} entries for fittype {}'.format(npar, fittype))
+        self.fit_args = (p0, bounds, window, fittype)
+        self.workers = workers
+        self.chunksize = chunksize
+
+        self.freq = np.asarray(self.dvs.indexes['freq'], dtype = float)
+        self.vals = np.ascontiguousarray(self.vss.values, dtype = float)
+        self.starts = list(range(0, len(self.vals), chunksize))
+        self.labels = _labels(fittype)
+
+        self.done = {}
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._t_start = None
+        self._n_start = 0
+
+        self._check_job()
+        self._load_checkpoints()
+
+    def _job_meta(self):
+        h = hashlib.sha1(self.vals.tobytes())
+        h.update(self.freq.tobytes())
+        settings = json.dumps([self.fit_args, self.chunksize], default = str)
+        return {'data' : h.hexdigest(), 'settings' : settings}
+
+    def _check_job(self):
+        """make sure the checkpoints in checkpoint_dir belong to this job"""
+        meta = self._job_meta()
+        entry = cache.load(self.checkpoint_dir, 'job')
+        if entry is None:
+            cache.store(self.checkpoint_dir, 'job', meta)
+        elif entry[0] != meta:
+            raise ValueError('checkpoint_dir ' + self.checkpoint_dir + ' holds checkpoints of a different job')
+
+    def _load_checkpoints(self):
+        for start in self.starts:
+            entry = cache.load(self.checkpoint_dir, 'chunk_{}'.format(start), mmap_mode = None)
+            if entry is not None:
+                self.done[start] = (entry[1]['fits'], entry[1]['params'], entry[1]['perr'])
+
+    def _run(self):
+        todo = [start for start in self.starts if start not in self.done]
+        self._t_start, self._n_start = time.time(), self.n_done()
+        try:
+            if self.workers == 1:
+                for start in todo:
+                    if self._stop.is_set():
+                        break
+                    self._finish(start, _fit_chunk(self.freq, self.vals[start:start+self.chunksize], *self.fit_args))
+            else:
+                with concurrent.futures.ProcessPoolExecutor(self.workers) as ex:
+                    futures = {ex.submit(_fit_chunk, self.freq, self.vals[start:start+self.chunksize], *self.fit_args) : start for start in todo}
+                    for future in concurrent.futures.as_completed(futures):
+                        if self._stop.is_set():
+                            for f in futures:
+                                f.cancel()
+                            break
+                        self._finish(futures[future], future.result())
+        except Exception as e:
+            self.error = e
+
+    def _finish(self, start, out):
+        fits, params, perr = out
+        cache.store(self.checkpoint_dir, 'chunk_{}'.format(start), {'start' : start}, fits = fits, params = params, perr = perr)
+        self.done[start] = out
+
+    def start(self):
+        """Fit the remaining time points in a background thread"""
+        if self.running():
+            return self
+        self._stop.clear()
+        self.error = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop after the chunks in progress, finished chunks stay checkpointed"""
+        self._stop.set()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self, timeout = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.error is not None:
+            raise self.error
+
+    def n_done(self):
+        """number of time points fitted"""
+        return sum(len(self.done[start][0]) for start in list(self.done))
+
+    def n_failed(self):
+        """number of time points with data whose fit did not converge"""
+        n = 0
+        for start, (fits, params, perr) in list(self.done.items()):
+            empty = np.isnan(self.vals[start:start+len(params)]).all(axis = 1)
+            n += int((np.isnan(params).all(axis = 1) & ~empty).sum())
+        return n
+
+    def progress(self):
+        """
+        dict with the number of time points done and total, the fraction, elapsed seconds, the ETA in seconds
+        and the number of time points whose fit failed
+        """
+        n, total = self.n_done(), len(self.vals)
+        elapsed = time.time() - self._t_start if self._t_start is not None else 0
+        rate = (n - self._n_start)/elapsed if elapsed > 0 else 0
+        eta = (total - n)/rate if rate > 0 else (0 if n == total else np.nan)
+        return {'done' : n, 'total' : total, 'fraction' : n/total if total else 1, 'elapsed' : elapsed, 'eta' : eta,
+                'failed' : self.n_failed()}
+
+    def result(self, wait = True):
+        """
+        Dataset with dvs, vss and fits over (time, freq) and the fit params and perr over (time, param).
+        Time points not fitted yet are nan, wait = True starts the job if needed and waits for it.
+        """
+        if wait:
+            if len(self.done) < len(self.starts):
+                self.start()
+            self.wait()
+
+        fits = np.full(self.vals.shape, np.nan)
+        params = np.full((len(self.vals), len(self.labels)), np.nan)
+        perr = np.full_like(params, np.nan)
+        for start, (f, p, e) in list(self.done.items()):
+            fits[start:start+len(f)], params[start:start+len(f)], perr[start:start+len(f)] = f, p, e
+
+        coords = {'time' : self.dvs.coords['time'], 'freq' : self.dvs.coords['freq'], 'param' : self.labels}
+        dst = xr.Dataset({'dvs' : self.dvs, 'vss' : self.vss,
+                          'fits' : (('time','freq'), fits),
+                          'params' : (('time','param'), params),
+                          'perr' : (('time','param'), perr)}, coords = coords)
+        if self.v0 is not None:
+            dst['v0'] = self.v0
+        return dst
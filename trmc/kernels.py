@@ -0,0 +1,195 @@
+"""
+Inner loops of the kinetic model (recombination rate and the fixed step integrators)
+
+Every kernel has a NumPy version and, when numba is installed, a compiled version with fused
+loops. Both do the same floating point operations in the same order so they give identical
+results. Neither allocates inside the time loop, the NumPy versions work on preallocated
+buffers through out= arguments.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+backends = ['numpy'] + (['numba'] if numba is not None else [])
+backend = backends[-1]
+
+
+def set_backend(name):
+    """Set the default backend, 'numpy' or 'numba'"""
+    global backend
+    backend = _get_backend(name)
+
+def _get_backend(name):
+    name = backend if name is None else name
+    if name not in backends:
+        raise ValueError('backend must be one of ' + str(backends))
+    return name
+
+
+###NumPy###
+# n^2 and n^3 are written as products, numpy's vectorized pow is not bit identical
+# to the scalar one (or to numba's) but products are.
+
+def _rate_np(n, k1, k2, k3, out, n2, n3):
+    """out = -k1*n - k2*n^2 - k3*n^3, n2 and n3 are scratch buffers"""
+    np.multiply(n, k1, out = out)
+    np.negative(out, out = out)
+    np.multiply(n, n, out = n2)
+    np.multiply(n2, n, out = n3)
+    n2 *= k2
+    n3 *= k3
+    out -= n2
+    out -= n3
+    return out
+
+def _cumtrapz_np(dng, t, k1, k2, k3, n):
+    shape = n.shape[1:]
+    dt = np.diff(t)
+    dn_prev, dn, n2, n3 = [np.empty(shape) for i in range(4)]
+    _rate_np(n[0], k1, k2, k3, dn_prev, n2, n3)
+    dn_prev += dng[0]
+    for i in range(3,len(t)):
+        _rate_np(n[i-2], k1, k2, k3, dn, n2, n3)
+        dn += dng[i-2]
+        np.add(dn_prev, dn, out = n[i])
+        n[i] *= 0.5*dt[i-3]
+        n[i] += n[i-1]
+        dn_prev, dn = dn, dn_prev
+    return n
+
+def _heun_np(dng, t, k1, k2, k3, n):
+    shape = n.shape[1:]
+    dt = np.diff(t)
+    dn_prev, dn_pred, n_pred, n2, n3 = [np.empty(shape) for i in range(5)]
+    _rate_np(n[0], k1, k2, k3, dn_prev, n2, n3)
+    dn_prev += dng[0]
+    for i in range(1,len(t)):
+        np.multiply(dn_prev, dt[i-1], out = n_pred)
+        n_pred += n[i-1]
+        _rate_np(n_pred, k1, k2, k3, dn_pred, n2, n3)
+        dn_pred += dng[i]
+        np.add(dn_prev, dn_pred, out = n[i])
+        n[i] *= 0.5*dt[i-1]
+        n[i] += n[i-1]
+        _rate_np(n[i], k1, k2, k3, dn_prev, n2, n3)
+        dn_prev += dng[i]
+    return n
+
+# A single trace is faster as a loop over python floats than as size one ufunc calls,
+# the arithmetic is the same IEEE double arithmetic.
+
+def _rate_py(x, k1, k2, k3):
+    x2 = x*x
+    return -(x*k1) - x2*k2 - (x2*x)*k3
+
+def _cumtrapz_py(dng, t, k1, k2, k3, n):
+    dng, t = dng.tolist(), t.tolist()
+    k1, k2, k3 = float(k1), float(k2), float(k3)
+    out = [0.0]*len(t)
+    dn_prev = _rate_py(0.0, k1, k2, k3) + dng[0]
+    for i in range(3,len(t)):
+        dn = _rate_py(out[i-2], k1, k2, k3) + dng[i-2]
+        out[i] = (dn_prev + dn)*(0.5*(t[i-2] - t[i-3])) + out[i-1]
+        dn_prev = dn
+    n[:] = out
+    return n
+
+def _heun_py(dng, t, k1, k2, k3, n):
+    dng, t = dng.tolist(), t.tolist()
+    k1, k2, k3 = float(k1), float(k2), float(k3)
+    out = [0.0]*len(t)
+    dn_prev = _rate_py(0.0, k1, k2, k3) + dng[0]
+    for i in range(1,len(t)):
+        dt = t[i] - t[i-1]
+        n_pred = dn_prev*dt + out[i-1]
+        dn_pred = _rate_py(n_pred, k1, k2, k3) + dng[i]
+        out[i] = (dn_prev + dn_pred)*(0.5*dt) + out[i-1]
+        dn_prev = _rate_py(out[i], k1, k2, k3) + dng[i]
+    n[:] = out
+    return n
+
+
+###numba###
+# The same operations as above on flattened (time, cell) arrays, one pass over the cells per step.
+
+if numba is not None:
+    @numba.njit(cache = True)
+    def _rate_nb(x, k1, k2, k3):
+        x2 = x*x
+        return -(x*k1) - x2*k2 - (x2*x)*k3
+
+    @numba.njit(cache = True)
+    def _dnr_nb(n, k1, k2, k3, out):
+        for j in range(n.size):
+            out[j] = _rate_nb(n[j], k1, k2, k3)
+        return out
+
+    @numba.njit(cache = True)
+    def _cumtrapz_nb(dng, t, k1, k2, k3, n):
+        M = n.shape[1]
+        dn_prev = np.empty(M)
+        for j in range(M):
+            dn_prev[j] = _rate_nb(n[0,j], k1[j], k2[j], k3[j]) + dng[0,j]
+        for i in range(3,len(t)):
+            h = 0.5*(t[i-2] - t[i-3])
+            for j in range(M):
+                dn = _rate_nb(n[i-2,j], k1[j], k2[j], k3[j]) + dng[i-2,j]
+                n[i,j] = (dn_prev[j] + dn)*h + n[i-1,j]
+                dn_prev[j] = dn
+        return n
+
+    @numba.njit(cache = True)
+    def _heun_nb(dng, t, k1, k2, k3, n):
+        M = n.shape[1]
+        dn_prev = np.empty(M)
+        for j in range(M):
+            dn_prev[j] = _rate_nb(n[0,j], k1[j], k2[j], k3[j]) + dng[0,j]
+        for i in range(1,len(t)):
+            dt = t[i] - t[i-1]
+            h = 0.5*dt
+            for j in range(M):
+                n_pred = dn_prev[j]*dt + n[i-1,j]
+                dn_pred = _rate_nb(n_pred, k1[j], k2[j], k3[j]) + dng[i,j]
+                n[i,j] = (dn_prev[j] + dn_pred)*h + n[i-1,j]
+                dn_prev[j] = _rate_nb(n[i,j], k1[j], k2[j], k3[j]) + dng[i,j]
+        return n
+
+
+###Dispatch###
+
+def rate(n, k1, k2, k3, out = None, backend = None):
+    """Recombination rate -k1*n - k2*n^2 - k3*n^3 of an array n for scalar rate constants"""
+    n = np.asarray(n, dtype = float)
+    if out is None:
+        out = np.empty(n.shape)
+    if _get_backend(backend) == 'numba':
+        _dnr_nb(np.ascontiguousarray(n).reshape(-1), float(k1), float(k2), float(k3), out.reshape(-1))
+    else:
+        _rate_np(n, k1, k2, k3, out, np.empty(n.shape), np.empty(n.shape))
+    return out
+
+def _integrate(dng, t, k1, k2, k3, np_kernel, py_kernel, nb_kernel, backend):
+    """broadcast the inputs, allocate n once and run the kernel of the backend"""
+    t = np.asarray(t, dtype = float)
+    shape = np.broadcast(dng[0], k1, k2, k3).shape
+    n = np.zeros((len(t),) + shape)
+    if _get_backend(backend) == 'numba':
+        dng = np.ascontiguousarray(np.broadcast_to(dng, n.shape), dtype = float).reshape(len(t), -1)
+        k1, k2, k3 = [np.ascontiguousarray(np.broadcast_to(k, shape), dtype = float).reshape(-1) for k in (k1,k2,k3)]
+        nb_kernel(dng, t, k1, k2, k3, n.reshape(len(t), -1))
+    elif shape == ():
+        py_kernel(np.asarray(dng, dtype = float), t, k1, k2, k3, n)
+    else:
+        np_kernel(dng, t, k1, k2, k3, n)
+    return n
+
+def cumtrapz(dng, t, k1, k2, k3, backend = None):
+    """lagged running trapezoid of dng + rate(n), dng is time major and broadcasts against the rate constants"""
+    return _integrate(dng, t, k1, k2, k3, _cumtrapz_np, _cumtrapz_py, _cumtrapz_nb if numba is not None else None, backend)
+
+def heun(dng, t, k1, k2, k3, backend = None):
+    """explicit trapezoid (Heun) steps of dng + rate(n)"""
+    return _integrate(dng, t, k1, k2, k3, _heun_np, _heun_py, _heun_nb if numba is not None else None, backend)
@@ -1,34 +1,346 @@
 import pandas as pd
 import numpy as np
+import itertools
 
+from trmc import kernels, timing
 
-def calc_pow(t,I0,params):
-    """Calulcates the time dependent power of the pulse"""
+
+def calc_pow(t,I0,params, series = True):
+    """Calulcates the time dependent power of the pulse, series = False returns arrays instead of Series"""
     sig = params['FWHM']/(2*np.sqrt(2*np.log(2)))
     p0 = (I0/(sig*np.sqrt(2*np.pi)))
     power = p0*np.exp(-((t-params['t0'])**2)/(2*(sig**2)))
-    power = pd.Series(power, index = t)
     dng = (params['FA']/params['d'])*power
+    if series:
+        power, dng = pd.Series(power, index = t), pd.Series(dng, index = t)
     return power, dng
 
-def dnr(n,k1,k2,k3):
-    """Recombination rate"""
-    dnr = np.zeros(len(n))
-    if(k1 != 0):
-        dnr = dnr - k1*n
-    if(k2 != 0):
-        dnr = dnr - k2*n**2
-    if(k3 != 0):
-        dnr = dnr - k3*n**3
-    return dnr
-
-def calc_n(dng,k1,k2,k3):
-    """numerical integration to find number density"""
-    t = dng.index
-    n = pd.Series(np.zeros(len(t)),index = t)
-    for i in range(1,len(t)):
-        dng_t = dng.iloc[:i-1]
-        dnr_t = dnr(n.iloc[:i-1],k1,k2,k3)
-        dn_t = dng_t + dnr_t
-        n.iloc[i] = np.trapz(dn_t,t[:i-1])
-    return n
\ No newline at end of file
+def calc_dng(t,I0,params):
+    """Generation rate for an array of pulse intensities I0, returns an array of shape (len(I0), len(t))"""
+    t = np.asarray(t, dtype = float)
+    I0 = np.atleast_1d(np.asarray(I0, dtype = float))
+    sig = params['FWHM']/(2*np.sqrt(2*np.log(2)))
+    pulse = np.exp(-((t-params['t0'])**2)/(2*(sig**2)))/(sig*np.sqrt(2*np.pi))
+    return (params['FA']/params['d'])*I0[:,np.newaxis]*pulse[np.newaxis,:]
+
+def dnr(n,k1,k2,k3, out = None, backend = None):
+    """Recombination rate, out is an optional array to write into (see kernels)"""
+    rate = kernels.rate(n,k1,k2,k3, out = out, backend = backend)
+    if isinstance(n, pd.Series):
+        rate = pd.Series(rate, index = n.index)
+    return rate
+
+def _rate(n,k1,k2,k3):
+    """Recombination rate that broadcasts against arrays of rate constants, same operations as the kernels"""
+    n2 = n*n
+    return -(n*k1) - n2*k2 - (n2*n)*k3
+
+
+###Integrators###
+# All integrators work on time-major arrays (time first) so each step is a
+# contiguous slice. dng has shape (len(t), ...) and the rate constants must
+# broadcast against dng[0]. The fixed step schemes run in trmc.kernels, with
+# numba when it is installed.
+
+def _int_cumtrapz(dng, t, k1, k2, k3, backend = None):
+    """
+    Running trapezoid sum. This is the linear time version of the original
+    calc_n loop, which integrated dng + dnr up to t[i-2] to get n[i].
+    """
+    return kernels.cumtrapz(dng, t, k1, k2, k3, backend = backend)
+
+def _int_heun(dng, t, k1, k2, k3, backend = None):
+    """Explicit trapezoid (Heun) predictor-corrector, second order with no lag"""
+    return kernels.heun(dng, t, k1, k2, k3, backend = backend)
+
+def _int_ode(dng, t, k1, k2, k3, ode_method = 'LSODA', rtol = 1e-6, atol = None, max_step = None, backend = None):
+    """
+    Stiff ODE solver from scipy, dng is linearly interpolated between time points.
+    max_step defaults to the time spacing so the solver can't step over the pulse.
+    backend is ignored, the right hand side is evaluated with numpy.
+    """
+    import scipy.integrate
+    import scipy.sparse
+
+    shape = np.broadcast(dng[0], k1, k2, k3).shape
+    dng = np.broadcast_to(dng, (len(t),) + shape).reshape(len(t),-1)
+    k1, k2, k3 = [np.broadcast_to(k, shape).ravel() for k in (k1,k2,k3)]
+
+    if atol is None:
+        # generation sets the density scale, default to a small fraction of it
+        atol = max(np.abs(dng).max()*(t[-1] - t[0])*1e-9, 1e-300)
+    if max_step is None:
+        max_step = np.diff(t).max()
+
+    def fun(tt, n):
+        idx = np.clip(np.searchsorted(t, tt, side = 'right') - 1, 0, len(t) - 2)
+        w = (tt - t[idx])/(t[idx+1] - t[idx])
+        g = dng[idx]*(1-w) + dng[idx+1]*w
+        return g + _rate(n,k1,k2,k3)
+
+    def jac(tt, n):
+        d = -(k1 + 2*k2*n + 3*k3*n**2)
+        if ode_method == 'LSODA':
+            return np.diag(d)
+        return scipy.sparse.diags(d)
+
+    sol = scipy.integrate.solve_ivp(fun, (t[0],t[-1]), np.zeros(dng.shape[1]), method = ode_method,
+                                    t_eval = t, jac = jac, rtol = rtol, atol = atol,
+                                    max_step = max_step)
+    if not sol.success:
+        raise RuntimeError('ODE integration failed: ' + sol.message)
+    return sol.y.T.reshape((len(t),) + shape)
+
+integrators = {
+    'cumtrapz' : _int_cumtrapz,
+    'heun' : _int_heun,
+    'ode' : _int_ode,
+}
+
+@timing.timed
+def calc_n(dng,k1,k2,k3, method = 'cumtrapz', t = None, backend = None, **ode_kws):
+    """
+    numerical integration to find number density
+
+    dng - generation rate, a Series indexed by time or an array (then t is required)
+    method - 'cumtrapz' reproduces the original trapezoid scheme in linear time,
+             'heun' is a second order predictor-corrector without the two step lag,
+             'ode' uses a stiff scipy solver (ode_method, rtol, atol can be passed)
+    backend - 'numpy' or 'numba' for cumtrapz and heun, defaults to kernels.backend
+    """
+    if isinstance(dng, pd.Series):
+        t = dng.index.values
+    elif t is None:
+        raise ValueError('t is required when dng is not a Series')
+
+    t = np.asarray(t, dtype = float)
+    dng_arr = np.asarray(dng, dtype = float)
+
+    if method not in integrators:
+        raise ValueError('method must be one of ' + str(list(integrators)))
+
+    n = integrators[method](dng_arr, t, k1, k2, k3, backend = backend, **ode_kws)
+
+    if isinstance(dng, pd.Series):
+        n = pd.Series(n, index = dng.index)
+    return n
+
+
+def k_grid(k1s,k2s,k3s):
+    """Every combination of the rate constants as an array of shape (n_params, 3) for calc_n_batch"""
+    return np.array(list(itertools.product(np.atleast_1d(k1s),np.atleast_1d(k2s),np.atleast_1d(k3s))), dtype = float)
+
+@timing.timed
+def calc_n_batch(t, I0, params, ks, method = 'cumtrapz', chunksize = None, backend = None, **ode_kws):
+    """
+    Number density for every combination of fluence and rate constants in one vectorized pass
+
+    t - time array
+    I0 - array of pulse intensities (n_fluence)
+    ks - array of (k1,k2,k3) rows (n_params x 3), see k_grid
+    chunksize - number of parameter sets integrated together, limits memory for big grids
+    backend - 'numpy' or 'numba' for cumtrapz and heun, defaults to kernels.backend
+
+    returns an array of shape (n_params, n_fluence, n_time)
+    """
+    t = np.asarray(t, dtype = float)
+    ks = np.atleast_2d(np.asarray(ks, dtype = float))
+    dng = calc_dng(t, I0, params).T[:,np.newaxis,:] # (time, 1, fluence)
+
+    if method not in integrators:
+        raise ValueError('method must be one of ' + str(list(integrators)))
+    if chunksize is None:
+        chunksize = len(ks)
+
+    n = np.empty((len(ks), dng.shape[2], len(t)))
+    for start in range(0, len(ks), chunksize):
+        k = ks[start:start+chunksize]
+        n_t = integrators[method](dng, t, k[:,0:1], k[:,1:2], k[:,2:3], backend = backend, **ode_kws)
+        n[start:start+chunksize] = np.moveaxis(n_t, 0, -1)
+    return n
+
+
+###Global fitting###
+
+fit_pnames = ['A','k1','k2','k3','FWHM','t0']
+typical_scales = {'A' : 1, 'k1' : 1e6, 'k2' : 1e-10, 'k3' : 1e-28, 'FWHM' : 1e-9, 't0' : 1e-9}
+
+def _dng_sens(t, I0, params):
+    """Generation rate (time, fluence) and its derivatives wrt FWHM and t0 (time, 2, fluence)"""
+    kappa = 1/(2*np.sqrt(2*np.log(2)))
+    sig = params['FWHM']*kappa
+    dng = calc_dng(t, I0, params).T
+    dt = (t - params['t0'])[:,np.newaxis]
+    d_sig = dng*(dt**2/sig**3 - 1/sig)
+    d_t0 = dng*dt/sig**2
+    return dng, np.stack([d_sig*kappa, d_t0], axis = 1)
+
+def _int_sens(dng, ddng, t, k1, k2, k3, method = 'cumtrapz'):
+    """
+    Integrate n along with its sensitivities to (k1,k2,k3,FWHM,t0) using the
+    same discrete scheme as the integrator, so the Jacobian is exact for the model.
+
+    dng is (time, fluence), ddng is (time, 2, fluence)
+    returns n (time, fluence) and S (time, 5, fluence)
+    """
+    def deriv(i, n, S):
+        """time derivative of n and S at time index i"""
+        dn = dng[i] + _rate(n,k1,k2,k3)
+        dr = -(k1 + 2*k2*n + 3*k3*n**2)
+        D = dr*S
+        D[0] -= n
+        D[1] -= n**2
+        D[2] -= n**3
+        D[3:] += ddng[i]
+        return dn, D
+
+    n = np.zeros(dng.shape)
+    S = np.zeros((len(t), 5, dng.shape[1]))
+    h = np.diff(t)
+
+    if method == 'cumtrapz':
+        d_prev = deriv(0, n[0], S[0])
+        for i in range(3,len(t)):
+            d = deriv(i-2, n[i-2], S[i-2])
+            n[i] = n[i-1] + 0.5*h[i-3]*(d_prev[0] + d[0])
+            S[i] = S[i-1] + 0.5*h[i-3]*(d_prev[1] + d[1])
+            d_prev = d
+    elif method == 'heun':
+        d_prev = deriv(0, n[0], S[0])
+        for i in range(1,len(t)):
+            d_pred = deriv(i, n[i-1] + h[i-1]*d_prev[0], S[i-1] + h[i-1]*d_prev[1])
+            n[i] = n[i-1] + 0.5*h[i-1]*(d_prev[0] + d_pred[0])
+            S[i] = S[i-1] + 0.5*h[i-1]*(d_prev[1] + d_pred[1])
+            d_prev = deriv(i, n[i], S[i])
+    else:
+        raise ValueError('sensitivities are only available for cumtrapz and heun')
+    return n, S
+
+def fit_global(traces, params, p0, vary = ('A','k1','k2','k3','FWHM','t0'), bounds = None, method = 'cumtrapz', **lsq_kws):
+    """
+    Fit shared rate constants and pulse parameters to a set of fluence traces at once.
+
+    The model for each trace is A*n(t) where n is found with calc_n from the generation rate of calc_pow.
+
+    traces - DataFrame with time index and fluence columns, or a Series with (fluence, time) levels
+             such as s.loc[direction, freq] from load.freqfluence_load
+    params - dict with 'FA' and 'd' (plus 'FWHM' and 't0' if not in p0)
+    p0 - dict of starting values for A, k1, k2, k3, FWHM, t0. A is solved linearly if not given.
+         The popt of a previous fit can be passed to warm start.
+    vary - names of the parameters to fit, the rest are held at p0
+    bounds - dict of name : (low, high), defaults to positive values for everything but A
+    method - integrator, 'cumtrapz' and 'heun' use an exact Jacobian, 'ode' falls back to finite differences
+
+    returns popt, perr (Series indexed by parameter name) and the residuals (DataFrame like traces)
+    """
+    import scipy.optimize
+
+    if isinstance(traces, pd.Series):
+        traces = traces.unstack('fluence') if 'fluence' in traces.index.names else traces.unstack(0)
+    traces = traces.dropna(axis = 1, how = 'all')
+
+    t = traces.index.values.astype(float)
+    I0 = traces.columns.values.astype(float)
+    y = traces.values
+    mask = ~np.isnan(y)
+
+    p = {name : params[name] for name in ['FWHM','t0'] if name in params}
+    p.update(dict(p0))
+    vary = [name for name in fit_pnames if name in vary]
+    if 'A' not in p:
+        p['A'] = 1.0
+        if 'A' not in vary:
+            raise ValueError('A must be in p0 when it is not varied')
+
+    # the optimizer works on parameters divided by their starting magnitude so the
+    # rate constants (which span ~40 orders of magnitude) are all of order one
+    scale = np.array([abs(p[name]) if p.get(name, 0) != 0 else typical_scales[name] for name in vary])
+
+    cache = {}
+    def model(x):
+        key = x.tobytes()
+        if key not in cache:
+            cache.clear()
+            pp = dict(p, **dict(zip(vary, x*scale)))
+            pulse = dict(params, FWHM = pp['FWHM'], t0 = pp['t0'])
+            dng, ddng = _dng_sens(t, I0, pulse)
+            if method == 'ode':
+                n, S = integrators[method](dng, t, pp['k1'], pp['k2'], pp['k3']), None
+            else:
+                n, S = _int_sens(dng, ddng, t, pp['k1'], pp['k2'], pp['k3'], method = method)
+            cache[key] = (pp, n, S)
+        return cache[key]
+
+    def fun(x):
+        pp, n, S = model(x)
+        return (pp['A']*n - y)[mask]
+
+    def jac(x):
+        pp, n, S = model(x)
+        cols = []
+        for name in vary:
+            if name == 'A':
+                cols.append(n[mask])
+            else:
+                cols.append(pp['A']*S[:, fit_pnames.index(name) - 1][mask])
+        return np.stack(cols, axis = 1)*scale
+
+    if 'A' in vary and 'A' not in p0:
+        # closed form amplitude for the starting rate constants
+        pp, n, S = model(np.ones(len(vary)))
+        p['A'] = np.sum(n[mask]*y[mask])/np.sum(n[mask]**2)
+        scale[vary.index('A')] = abs(p['A'])
+        cache.clear()
+
+    default_bounds = {name : (0, np.inf) for name in fit_pnames}
+    default_bounds['A'] = (-np.inf, np.inf)
+    default_bounds['t0'] = (-np.inf, np.inf)
+    if bounds is not None:
+        default_bounds.update(bounds)
+    lb = np.array([default_bounds[name][0] for name in vary])/scale
+    ub = np.array([default_bounds[name][1] for name in vary])/scale
+
+    x0 = np.clip(np.array([p[name] for name in vary], dtype = float)/scale, lb, ub)
+    res = scipy.optimize.least_squares(fun, x0, jac = '2-point' if method == 'ode' else jac,
+                                       bounds = (lb, ub), **lsq_kws)
+
+    # covariance from the jacobian at the solution, as curve_fit does
+    _, sv, VT = np.linalg.svd(res.jac, full_matrices = False)
+    threshold = np.finfo(float).eps*max(res.jac.shape)*sv[0]
+    sv, VT = sv[sv > threshold], VT[:sv[sv > threshold].size]
+    pcov = (VT.T/sv**2) @ VT
+    dof = max(mask.sum() - len(vary), 1)
+    pcov = pcov*2*res.cost/dof
+
+    pp, n, S = model(res.x)
+    popt = pd.Series([pp[name] for name in fit_pnames], index = fit_pnames)
+    perr = pd.Series(0.0, index = fit_pnames)
+    perr[vary] = np.sqrt(np.diag(pcov))*scale
+    resid = pd.DataFrame(pp['A']*n - y, index = traces.index, columns = traces.columns)
+    return popt, perr, resid
+
+def fit_global_all(s, params, p0, **fit_kws):
+    """
+    Run fit_global for every (direction, freq) in a Series from load.freqfluence_load.
+    Each fit is warm started from the previous one.
+
+    returns a DataFrame of fit parameters, errors and rms residual per (direction, freq)
+    and a Series of residuals with the index of s
+    """
+    rows = {}
+    resids = []
+    p_start = dict(p0)
+    for key, traces in s.groupby(level = ['direction','freq'], sort = False):
+        traces = traces.droplevel(['direction','freq'])
+        if traces.isnull().all():
+            continue
+        popt, perr, resid = fit_global(traces, params, p_start, **fit_kws)
+        p_start = popt.to_dict()
+        rows[key] = pd.concat([popt, perr.add_suffix('_err'), pd.Series({'rms' : np.sqrt(np.nanmean(resid.values**2))})])
+        resid = resid.stack().reorder_levels(['fluence', resid.index.name or 'time'])
+        resids.append(pd.concat({key : resid}, names = ['direction','freq']))
+
+    df_p = pd.DataFrame(rows).T
+    df_p.index.names = ['direction','freq']
+    s_resid = pd.concat(resids).reindex(s.index)
+    return df_p, s_resid
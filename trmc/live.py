@@ -0,0 +1,129 @@
+"""
+Live analysis of a FreqFluence folder while the acquisition is writing to it
+"""
+import os
+import re
+import time
+
+import pandas as pd
+
+from trmc import load, analysis
+
+
+class LiveRun():
+    """
+    Follows a FreqFluence folder (<freq>GHz_<direction> subfolders of trace files) during a run.
+
+    Every poll picks up only the files that appeared since the last one, parses them (through the
+    cache if cache_dir is given) and updates deltaG, maxG and the figure of merit. Nothing already
+    processed is read again. Results are in the results DataFrame indexed by (direction, freq, fluence)
+    and the deltaG traces in cond.
+
+    K - a number or anything indexed by (direction, freq), such as the K column of analysis.fit_dcs
+    K_err, back_V_err - errors propagated to maxG_err and fom_err (see analysis.stream_cond)
+    params - figure of merit parameters for analysis.maxG_and_fom
+    settle - files modified less than this many seconds ago are left for the next poll as the
+             acquisition may still be writing them
+    """
+    folder_re = re.compile(r'^(\d+\.\d+)GHz_(.+?)')
+    file_re = re.compile(r'.*Filter=\d+_Fluence=(.+?)_data.csv')
+
+    def __init__(self, direc, K, params, sub_lowpow = True, offsettime = 50e-9, cache_dir = None, settle = 0.2, K_err = 0, back_V_err = 0):
+        self.direc = direc
+        self.K = K
+        self.K_err = K_err
+        self.back_V_err = back_V_err
+        self.params = params
+        self.sub_lowpow = sub_lowpow
+        self.offsettime = offsettime
+        self.cache_dir = cache_dir
+        self.settle = settle
+
+        self.seen = set()
+        self.folder_mtimes = {}
+        self.volts = {}
+        self.back_Vs = {}
+        self.cond = {}
+        self.results = pd.DataFrame(columns = ['maxG','maxG_err','maxG_time','fom','fom_err'], dtype = float,
+                                    index = pd.MultiIndex.from_tuples([], names = ['direction','freq','fluence']))
+
+    def _new_files(self):
+        """(key, filepath) of trace files not processed yet, only rescanning folders that changed"""
+        new = []
+        now = time.time()
+        for folder in os.scandir(self.direc):
+            m_folder = self.folder_re.search(folder.name)
+            if m_folder is None or not folder.is_dir():
+                continue
+            mtime = folder.stat().st_mtime_ns
+            if self.folder_mtimes.get(folder.path) == mtime:
+                continue
+            settled = True
+            for entry in os.scandir(folder.path):
+                m_file = self.file_re.search(entry.name)
+                if m_file is None or entry.path in self.seen:
+                    continue
+                if now - entry.stat().st_mtime < self.settle:
+                    settled = False
+                    continue
+                key = (m_folder.groups()[1], float(m_folder.groups()[0])*1e9, float(m_file.groups()[0]))
+                new.append((key, entry.path))
+            if settled:
+                self.folder_mtimes[folder.path] = mtime
+        return new
+
+    def _update_group(self, group, new_keys):
+        """
+        deltaG and the results of the new traces of a (direction, freq). A new lowest fluence
+        changes the subtracted low power trace, then every trace of the group is recomputed.
+        """
+        keys = sorted(key for key in self.volts if key[:2] == group)
+        lp = self.volts[keys[0]] if self.sub_lowpow else 0
+        if not (self.sub_lowpow and keys[0] in new_keys):
+            keys = [key for key in keys if key in new_keys]
+        traces = ((key, self.volts[key] - lp, self.back_Vs[key]) for key in keys)
+        noise_window = (0, self.offsettime) if self.offsettime is not None else None
+        rows = {}
+        for key, cond, err in analysis.stream_cond(traces, self.K, self.K_err, self.back_V_err, noise_window):
+            self.cond[key] = cond
+            row, = analysis.stream_maxG_fom([(key, cond, err)], self.params)
+            rows[key] = {name : row[name] for name in self.results.columns}
+        rows = pd.DataFrame.from_dict(rows, orient = 'index')
+        rows.index.names = self.results.index.names
+        self.results = pd.concat([self.results.drop(rows.index, errors = 'ignore'), rows]).sort_index()
+
+    def poll(self):
+        """Process new files, returns their keys"""
+        processed = []
+        for key, fp in self._new_files():
+            try:
+                header, data = load.read_trace_file(fp, cache_dir = self.cache_dir)
+            except Exception:
+                # most likely still being written, try again next poll
+                self.folder_mtimes.pop(os.path.dirname(fp), None)
+                continue
+            self.seen.add(fp)
+            self.volts[key] = load._trace_series(header, data, self.offsettime)
+            self.back_Vs[key] = -header.back_V
+            processed.append(key)
+
+        new_keys = set(processed)
+        for group in set(key[:2] for key in processed):
+            self._update_group(group, new_keys)
+        return processed
+
+    def watch(self, interval = 0.5, callback = None, duration = None):
+        """
+        Poll every interval seconds until duration has passed (forever if None) or KeyboardInterrupt.
+        callback(self, new_keys) is called whenever new files were processed.
+        """
+        start = time.time()
+        try:
+            while duration is None or time.time() - start < duration:
+                new = self.poll()
+                if new and callback is not None:
+                    callback(self, new)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+        return self.results
@@ -4,11 +4,19 @@ import pandas as pd
 import numpy as np
 import re
 import xarray as xr
+import functools
 from IPython.display import clear_output
 
+from trmc import cache, timing
+
+
+@timing.timed
+def loadsweep(fp,defaultV = 0.025, cache_dir = None):
+    """Load in cavity sweep. defaultV if bad csv file saved. cache_dir caches the parsed sweep (see trmc.cache)""" 
+    if cache_dir is not None:
+        meta, arrays = cache.cached_parse(fp, functools.partial(_sweep_entry, defaultV = defaultV), cache_dir, 'sweep' + str(defaultV))
+        return pd.Series(arrays['values'], index = pd.Index(arrays['freq'], name = meta['index_name']), name = meta['name'])
 
-def loadsweep(fp,defaultV = 0.025):
-    """Load in cavity sweep. defaultV if bad csv file saved. """ 
     df = pd.read_csv(fp,index_col=False)
     
     if 'Experimental R' in df.columns:
@@ -20,71 +28,162 @@ def loadsweep(fp,defaultV = 0.025):
         s = df['Reflectivity']*defaultV
     return s
 
+def _sweep_entry(fp, defaultV):
+    """cache entry of a cavity sweep"""
+    s = loadsweep(fp, defaultV)
+    return {'name' : s.name, 'index_name' : s.index.name}, {'freq' : s.index.values, 'values' : s.values}
 
 
 #Load in cavity sweeeps
-def sweeps2ds(fps, regex = 'Sweep_(\d+)ms(.+)exp.csv', groupnames = ['swtime','tc']):
-    """load in all cavity sweeps in filepath dict"""
+def sweeps2ds(fps, regex = 'Sweep_(\d+)ms(.+)exp.csv', groupnames = ['swtime','tc'], cache_dir = None, catalog = None):
+    """
+    load in all cavity sweeps in filepath dict, cache_dir caches the parsed sweeps
+    catalog - a trmc.catalog.Catalog used to list the folders instead of os.listdir
 
-    
+    returns a Dataset with dims reversed(groupnames) + ['sample','freq'] on the sorted union of the 
+    coordinates, one variable per sweep column name, NaN where a sweep is missing.
+    """
+    regex = re.compile(regex)
 
-    das = []
+    sweeps = []
     for samp in fps:
         direc = fps[samp]
-        fns = os.listdir(direc)
+        fns = catalog.listdir(direc, samp) if catalog is not None else os.listdir(direc)
         for fn in fns:
-            m = re.search(regex,fn)
+            m = regex.search(fn)
             if m is None:
-                pass
-            else:
-                fp = os.path.join(direc,fn)
-      
-
-                s = loadsweep(fp)
-                s = s.rename(s.name.replace(' ', ''))
-                s.index = s.index.rename('freq')
-                da = xr.DataArray.from_series(s)
-                da = da.assign_coords(sample = samp).expand_dims('sample')
-
-                # swtime = int(m.groups()[0])
-                # tc = m.groups()[1]
+                continue
+            s = loadsweep(os.path.join(direc,fn), cache_dir = cache_dir)
+            sweeps.append((s.name.replace(' ', ''), (*m.groups()[:len(groupnames)][::-1], samp), s.index.values, s.values))
+
+    return _sweeps_dataset(sweeps, [*groupnames[::-1], 'sample'])
+
+def _sweeps_dataset(sweeps, dims):
+    """assemble (name, coords, freq, values) sweeps into one dense array per name"""
+    coords = {dim : sorted(set(sw[1][i] for sw in sweeps)) for i, dim in enumerate(dims)}
+    freq = np.unique(np.concatenate([sw[2] for sw in sweeps])) if sweeps else np.array([])
+    lookup = [{c : j for j, c in enumerate(coords[dim])} for dim in dims]
+    shape = tuple(len(coords[dim]) for dim in dims) + (len(freq),)
+
+    data = {}
+    for name, key, f, values in sweeps:
+        if name not in data:
+            data[name] = np.full(shape, np.nan)
+        idx = tuple(lookup[i][c] for i, c in enumerate(key))
+        data[name][idx][np.searchsorted(freq, f)] = values
+
+    coords['freq'] = freq
+    return xr.Dataset({name : ([*dims, 'freq'], arr) for name, arr in data.items()}, coords = coords)
+
+import io
+import collections
+
+TraceHeader = collections.namedtuple('TraceHeader', ['amp','back_V','back_V_unit','filter','fluence','columns','fields'])
+TraceHeader.__doc__ = """
+Header of a trace file
+
+amp - amplification
+back_V - background voltage in V (signed as written in the file)
+back_V_unit - unit prefix the background voltage was written with ('m', 'µ', ...)
+filter, fluence - from the header, or the filename if not in the header
+columns - names of the data columns
+fields - all header key : value strings
+"""
+
+header_nlines = 13 # key,value lines before the column names
+re_header_line = re.compile(r'^([^,]*),([^,]*)')
+re_voltage = re.compile(r'^\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*(\D?)V\s*$')
+re_filter_fluence = re.compile(r'Filter=(\d+)_Fluence=(.+?)_')
+unit_prefixes = {'' : 1, 'm' : 1e-3, 'u' : 1e-6, 'µ' : 1e-6, 'μ' : 1e-6, 'n' : 1e-9}
+
+def _to_float(s):
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return np.nan
+
+def parse_header(lines, filepath = ''):
+    """Parse the decoded header lines of a trace file into a TraceHeader"""
+    fields = {}
+    for line in lines[:header_nlines]:
+        m = re_header_line.match(line)
+        if m is not None:
+            fields[m.groups()[0].strip()] = m.groups()[1].strip()
+
+    back_V, unit = np.nan, None
+    m = re_voltage.match(fields.get('Background Voltage', ''))
+    if m is not None:
+        unit = m.groups()[1]
+        back_V = float(m.groups()[0])*unit_prefixes[unit]
+
+    filt, fluence = _to_float(fields.get('Filter')), _to_float(fields.get('Fluence'))
+    m = re_filter_fluence.search(os.path.basename(filepath))
+    if m is not None:
+        filt = filt if not np.isnan(filt) else _to_float(m.groups()[0])
+        fluence = fluence if not np.isnan(fluence) else _to_float(m.groups()[1])
+
+    columns = lines[header_nlines].strip().split(',') if len(lines) > header_nlines else []
+
+    return TraceHeader(_to_float(fields.get('Amplification')), back_V, unit, filt, fluence, columns, fields)
+
+@timing.timed
+def read_trace_file(filepath, data = True, cache_dir = None):
+    """
+    Read a trace file in a single pass
 
-                for i, nm in enumerate(groupnames):
-                    # d = {name :m.groups()[i]}
-                    da = da.assign_coords(temp = m.groups()[i]).expand_dims('temp')
-                    da = da.rename({'temp':nm})
-                # da = da.assign_coords(tc = tc).expand_dims('tc')
-                # da = da.assign_coords(swtime= swtime).expand_dims('swtime')
-                das.append(da)
+    cache_dir - parsed files are stored here and memory mapped on the next read (see trmc.cache)
 
-    ds = xr.merge(das)
-    return ds
+    returns the TraceHeader and the numeric data block as an array (or None if data is False)
+    """
+    if cache_dir is not None and data:
+        meta, arrays = cache.cached_parse(filepath, _trace_entry, cache_dir, 'trace')
+        return TraceHeader(**meta), arrays['data']
+
+    with open(filepath, 'rb') as f:
+        if data:
+            raw = f.read()
+        else:
+            raw = b''.join(f.readline() for i in range(header_nlines + 1))
+    timing.record('load.read_trace_file', bytes = len(raw))
+    lines = raw.split(b'\n', header_nlines + 1)
+
+    # latin-1 never fails to decode, a utf-8 µ then shows up as Âµ
+    header = parse_header([line.decode('latin-1').replace('Â', '') for line in lines[:header_nlines + 1]], filepath)
+
+    if data:
+        data = pd.read_csv(io.BytesIO(lines[-1]), header = None).to_numpy(dtype = float)
+    else:
+        data = None
+    return header, data
+
+def _trace_entry(filepath):
+    """cache entry of a trace file"""
+    header, data = read_trace_file(filepath)
+    return header._asdict(), {'data' : data}
+
+def _trace_series(header, data, offsettime = None):
+    """Voltage Series from a parsed trace file"""
+    col = header.columns.index('Voltage (V)')
+    volt = pd.Series(data[:,col], index = pd.Index(data[:,0], name = header.columns[0]), name = 'Voltage (V)')
+    if offsettime is not None:
+        volt = volt - np.mean(volt[0:offsettime])
+    return volt
 
 def read_params(filepath):
     """Read the amplification and background voltage from the header of a file"""
-    params = pd.read_csv(filepath, nrows = 11, usecols = [1])
-    params = params.transpose()
-    amp = float(params['Amplification'][0]) # Is amplification already taken into account?
-    # K = float(params['K'][0])
-    back_V = params['Background Voltage'][0].replace('V','')
-    unitdict = {'m':1e-3, 'u':1e-6}
-    scale = unitdict[back_V[-1]]
-    back_V = float(back_V[:len(back_V)-1])*scale # remove mV or uV and scale appropriately
-    return amp, back_V
+    header, _ = read_trace_file(filepath, data = False)
+    return header.amp, header.back_V
 
+@timing.timed
 def load_trace(filepath,offsettime = None):
     """load in a single trace csv file"""
-    temp = pd.read_csv(filepath, skiprows = 13, index_col=0)
-    volt = temp['Voltage (V)']
-    if offsettime is not None:
-        volt = volt - np.mean(volt[0:offsettime])
-
-    return volt
-    # time = volt.index
+    header, data = read_trace_file(filepath)
+    return _trace_series(header, data, offsettime)
 
 
+@timing.timed
 def freqfluence_flist(direc,file_re = '.*Filter=\d+_Fluence=(.+?)_data.csv', file_groupnames = ['fluence'], direction_used = True):
-    """Creates a multindexed Series of filepaths from a frequency fluence sweep folder"""
+    """Creates a multindexed Series of filepaths from a frequency fluence sweep folder (see also trmc.catalog)"""
     folders = os.listdir(direc)
     miarray = []
     if direction_used:
@@ -94,10 +193,12 @@ def freqfluence_flist(direc,file_re = '.*Filter=\d+_Fluence=(.+?)_data.csv', fil
 
     flist = []
 
+    folder_re = re.compile(folder_re)
+    file_re = re.compile(file_re)
+
     for folder in folders:
 
-        m_folder = re.search(folder_re,folder)
-        print(folder)
+        m_folder = folder_re.search(folder)
 
         freq = float(m_folder.groups(0)[0])*1e9
         
@@ -106,7 +207,7 @@ def freqfluence_flist(direc,file_re = '.*Filter=\d+_Fluence=(.+?)_data.csv', fil
         fns = os.listdir(folderpath)
         for fn in fns:
             #if file[0] == 'F':
-            m_file = re.search(file_re, fn)
+            m_file = file_re.search(fn)
             if m_file is None:
                 clear_output()
                 print("no match for file " + fn)
@@ -128,6 +229,7 @@ def freqfluence_flist(direc,file_re = '.*Filter=\d+_Fluence=(.+?)_data.csv', fil
     
     return s_fps
 
+@timing.timed
 def freqdcs_flist(direc):
     """Creates a multindexed Series of filepaths from a frequency dark cavity sweep folder"""
     folders = os.listdir(direc)
@@ -158,72 +260,95 @@ def freqdcs_flist(direc):
 
 
 import itertools
-def freqfluence_load(s_fps, sub_lowpow = True):
-    """Takes in a frequecny fluence sweep filepath Series and loads into a data Series"""
-    direcs = set(s_fps.index.levels[0])
+import concurrent.futures
+
+def _read_freqfluence_file(fp, offsettime = 50e-9, cache_dir = None):
+    """Read the time, offset corrected voltage and background voltage of a trace file in a single pass"""
+    header, data = read_trace_file(fp, cache_dir = cache_dir)
+    volt = _trace_series(header, data, offsettime)
+    return volt.index.values, volt.values, -header.back_V
+
+def freqfluence_load(s_fps, sub_lowpow = True, workers = None, executor = 'thread', cache_dir = None, dense = False):
+    """
+    Takes in a frequecny fluence sweep filepath Series and loads into a data Series
+
+    dense - return DataArrays with dims (direction, freq, fluence, time) and (direction, freq)
+            over the loaded arrays instead of multindexed Series
+
+    workers - number of threads/processes used to read the files, 1 reads serially
+    executor - 'thread' or 'process' pool
+    cache_dir - cache the parsed files and the loaded data here (see trmc.cache). 
+                Only new or changed files are parsed again.
+    """
+    direcs = sorted(set(s_fps.index.levels[0]))
     freqs = sorted(set(s_fps.index.levels[1]))
     fluences = sorted(set(s_fps.index.levels[2]))
-    
-    
-    miarray = itertools.product(direcs,freqs,fluences)
-    mi = pd.MultiIndex.from_tuples(miarray, names = ['direction','freq','fluence'])    
-    # mi = s_fps.index
-    time_arr = load_trace(s_fps.iloc[0]).index.values
-    miarray_t = itertools.product(direcs,freqs,fluences,time_arr)
-    # miarray_t = []
-    # for tup in mi:
-    #     for time in time_arr:
-    #         miarray_t.append((*tup,time))
 
-    data_bv = np.full([len(direcs)*len(freqs)*len(fluences)], np.nan)
+    tups = [tup for tup in itertools.product(direcs,freqs,fluences) if tup in s_fps]
+    fps = [s_fps[tup] for tup in tups]
 
-    mi_t = pd.MultiIndex.from_tuples(miarray_t, names = ['direction','freq','fluence','time'])    
+    if cache_dir is not None:
+        key = cache.combine_keys([cache.file_key(fp) for fp in fps] + [repr(tups)], 'freqfluence' + str(sub_lowpow))
+        entry = cache.load(cache_dir, key)
+        if entry is not None:
+            meta, arrays = entry
+            return _freqfluence_series(meta['direcs'], freqs, fluences, arrays['time'], arrays['data'], arrays['data_bv'], dense)
+
+    read = functools.partial(_read_freqfluence_file, cache_dir = cache_dir)
+    if workers == 1:
+        results = list(map(read, fps))
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor if executor == 'process' else concurrent.futures.ThreadPoolExecutor
+        with pool(workers) as ex:
+            results = list(ex.map(read, fps))
+    results = dict(zip(tups, results))
+
+    time_arr = results[s_fps.index[0]][0]
+
+    data_bv = np.full([len(direcs)*len(freqs)*len(fluences)], np.nan)
     
     shape = [len(direcs)*len(freqs)*len(fluences),len(time_arr)]
     data = np.full(shape, np.nan)
 
-    # backvs = []
     lowpow = min(fluences)
-    
-    re_backV = "^Background Voltage,-(\d+\.\d+)(.)V"
-    re_backV2 = "^Background Voltage,-(\d+)(.)V"
 
     lp = 0
     for i, tup in enumerate(itertools.product(direcs,freqs,fluences)):
         direc, freq, fluence = tup
-        if tup in s_fps:
-            fp = s_fps[direc,freq,fluence]
+        if tup in results:
+            _, d, data_bv[i] = results[tup]
             if(fluence == lowpow):
-                lp = load_trace(fp,50e-9).values
-                # data[i,:] = lp - lp
+                lp = d
 
-            d = load_trace(fp,50e-9).values
             if sub_lowpow:
                 try:
                     data[i,:] = d - lp
                 except:
-                    print('subtraction failed for ' + fp)
+                    print('subtraction failed for ' + s_fps[tup])
             else:
                 data[i,:] = d 
 
-            with open(fp) as p:
-                for n, line in enumerate(p):
-                    if n == 11:
-                        # line = line.encode('utf-8')
-                        if 'Â' in line:
-                            line = line.replace('Â', '')
+    if cache_dir is not None:
+        cache.store(cache_dir, key, {'direcs' : list(direcs)}, time = time_arr, data = data, data_bv = data_bv)
 
-                        m = re.search(re_backV,line)
-                        if m == None:
-                            m = re.search(re_backV2,line)
+    return _freqfluence_series(direcs, freqs, fluences, time_arr, data, data_bv, dense)
 
-                        if m.groups()[1] == 'm':
-                            fac = 1e-3
-                        elif m.groups()[1] == 'µ':
-                            fac = 1e-6
+def _freqfluence_series(direcs, freqs, fluences, time_arr, data, data_bv, dense = False):
+    """Multiindexed data and background voltage Series (or dense DataArrays) from the freqfluence_load arrays"""
+    if dense:
+        direcs = list(direcs)
+        shape = (len(direcs), len(freqs), len(fluences))
+        coords = {'direction' : direcs, 'freq' : freqs, 'fluence' : fluences, 'time' : time_arr}
+        da = xr.DataArray(data.reshape(*shape, len(time_arr)), dims = list(coords), coords = coords)
+        backvs = xr.DataArray(data_bv.reshape(shape)[:,:,-1], dims = ['direction','freq'],
+                              coords = {'direction' : direcs, 'freq' : freqs})
+        return da, backvs
 
-                        data_bv[i] = float(m.groups()[0])*fac
-                        # backvs.append(float(m.groups()[0])*fac)
+    miarray = itertools.product(direcs,freqs,fluences)
+    mi = pd.MultiIndex.from_tuples(miarray, names = ['direction','freq','fluence'])    
+
+    miarray_t = itertools.product(direcs,freqs,fluences,time_arr)
+    mi_t = pd.MultiIndex.from_tuples(miarray_t, names = ['direction','freq','fluence','time'])    
 
     data = data.flatten()
     
@@ -286,28 +411,36 @@ def dict_product(dicts):
     """
     return (dict(zip(dicts, x)) for x in itertools.product(*dicts.values()))
 
-def gen_seldicts(da, keys, check_empty = True):
-    idxs = {key : da.indexes[key] for key in keys}
-    seldicts = list(dict_product(idxs))
-    
-    seldicts_red = []    
+def populated_cells(da, keys):
+    """
+    Integer index array (ncells, len(keys)) of the combinations of keys in da that hold any non nan data,
+    in the same order as dict_product. Reduces notnull over the other dims once instead of selecting every cell.
+    """
+    other = [dim for dim in da.dims if dim not in keys]
+    mask = da.notnull().any(other).transpose(*keys).values
+    return np.argwhere(mask)
+
+def iter_cells(da, keys, check_empty = True):
+    """
+    Iterate over the selection dicts of the combinations of keys in da, check_empty skips all nan cells
+
+    >>> for seldict in iter_cells(da, ['direction','freq']):
+    ...     trace = da.sel(seldict)
+    """
+    idxs = [da.indexes[key] for key in keys]
     if check_empty:
-        for i, seldict in enumerate(seldicts):
-            t = da.sel(seldict)
-            if np.isnan(t).all().item() is False:
-                seldicts_red.append(seldict)
-        
-        seldicts = seldicts_red
-        
-        #Old method...think this fix some issue that came up at some point but can't remember
-#         seldicts_red = []   
-#         for i, seldict in enumerate(seldicts):
-#             t = da.sel(seldict).dropna('time').to_series()
-#             if len(t) != 0:
-#                 seldicts_red.append(seldict)
-#         seldicts = seldicts_red
-
-    return seldicts
+        cells = populated_cells(da, keys)
+    else:
+        cells = np.ndindex(*[len(idx) for idx in idxs])
+    for cell in cells:
+        yield {key : idx[i] for key, idx, i in zip(keys, idxs, cell)}
+
+def gen_seldicts(da, keys, check_empty = True):
+    """
+    List of selection dicts for every combination of the values of keys in da,
+    e.g. the dense DataArray from freqfluence_load. check_empty drops all nan selections.
+    """
+    return list(iter_cells(da, keys, check_empty))
 
 
 # basedir = '\\\\depot.engr.oregonstate.edu\\users\\coe_apirate\\Windows.Documents\\Desktop\\Data'
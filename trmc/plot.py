@@ -1,3 +1,5 @@
+import collections
+
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -18,27 +20,148 @@ class exp_formatter():
 
 
 
-def dvcolorplot(sweep, dvs , levels = list(np.arange(-3.1e-3,3.1e-3,1e-5))):
+def _time_freq(dvs):
+    """time, freq and a (time, freq) array of values from a multindex Series with time and freq levels or a DataArray"""
+    if hasattr(dvs, 'dims'):
+        dvs = dvs.transpose('time','freq')
+        return dvs.indexes['time'], dvs.indexes['freq'], dvs.values
+    freq = dvs.index.levels[1]
+    time = dvs.index.levels[0]
+    return time, freq, dvs.values.reshape(len(time),len(freq))
+
+
+###Decimated rendering###
+# Long traces are reduced to the extremes of each screen column of the visible range
+# and reduced again whenever the view changes, so drawing cost depends on the size of
+# the figure rather than the number of samples.
+
+def _visible(x, lim):
+    """slice of the sorted x inside lim, plus one point either side"""
+    if lim is None:
+        return slice(0, len(x))
+    lo = max(np.searchsorted(x, min(lim), 'left') - 1, 0)
+    hi = min(np.searchsorted(x, max(lim), 'right') + 1, len(x))
+    return slice(lo, hi)
+
+def _bins(y, npoints, fill):
+    """y (..., n) padded with fill and reshaped to (..., nbins, binsize) with at most npoints bins"""
+    n = y.shape[-1]
+    size = -(-n//npoints)
+    nbins = -(-n//size)
+    pad = np.full(y.shape[:-1] + (nbins*size - n,), fill)
+    return np.concatenate([y, pad], axis = -1).reshape(y.shape[:-1] + (nbins, size)), size
+
+def minmax_decimate(x, y, npoints = 1000, xlim = None):
+    """
+    Reduce lines y (..., len(x)) on a sorted x to the min and max of each of npoints bins of the part within xlim,
+    in their original order. Returns x and y of shape (..., 2*nbins), lines short enough are returned as they are.
+    """
+    x, y = np.asarray(x), np.asarray(y, dtype = float)
+    sl = _visible(x, xlim)
+    x, y = x[sl], y[...,sl]
+    if len(x) <= 2*npoints:
+        return np.broadcast_to(x, y.shape), y
+
+    y_nan = np.isnan(y)
+    b_min, size = _bins(np.where(y_nan, np.inf, y), npoints, np.inf)
+    b_max, size = _bins(np.where(y_nan, -np.inf, y), npoints, -np.inf)
+    imin, imax = b_min.argmin(axis = -1), b_max.argmax(axis = -1)
+    idx = np.stack([np.minimum(imin, imax), np.maximum(imin, imax)], axis = -1)
+    idx = (idx + size*np.arange(idx.shape[-2])[:,np.newaxis]).reshape(y.shape[:-1] + (-1,))
+    idx = np.minimum(idx, len(x) - 1)
+    return x[idx], np.take_along_axis(y, idx, axis = -1)
+
+def peak_decimate(t, z, npoints = 1000, tlim = None):
+    """
+    Reduce z (len(t), ...) along t to npoints bins within tlim keeping the value of largest magnitude in each bin,
+    so peaks of either sign survive. Returns the bin times (first of each bin) and the reduced z.
+    """
+    t, z = np.asarray(t), np.asarray(z, dtype = float)
+    sl = _visible(t, tlim)
+    t, z = t[sl], z[sl]
+    if len(t) <= npoints:
+        return t, z
+
+    zt = np.moveaxis(z, 0, -1)
+    b, size = _bins(np.where(np.isnan(zt), -1, np.abs(zt)), npoints, -1)
+    idx = b.argmax(axis = -1) + size*np.arange(b.shape[-2])
+    idx = np.minimum(idx, len(t) - 1)
+    return t[::size], np.moveaxis(np.take_along_axis(zt, idx, axis = -1), -1, 0)
+
+
+class DecimatedLines():
+    """
+    Keeps lines drawn from full resolution data at about one min/max pair per screen column
+    of the visible x range, redoing the decimation when the x limits change.
+
+    ax - axes, x - sorted x (N), ys - lines (nlines, N), lines - a Line2D for each line
+    npoints - number of bins, defaults to the width of the axes in pixels
+    """
+    def __init__(self, ax, x, ys, lines, npoints = None):
+        self.ax, self.x, self.ys, self.lines, self.npoints = ax, np.asarray(x), np.asarray(ys), lines, npoints
+        self.xlim = None
+        self.update()
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update(ax.get_xlim()))
+
+    def update(self, xlim = None):
+        if xlim is not None and self.xlim is not None and np.allclose(xlim, self.xlim):
+            return
+        self.xlim = xlim
+        npoints = self.npoints or max(int(self.ax.bbox.width), 100)
+        xd, yd = minmax_decimate(self.x, self.ys, npoints, xlim)
+        for line, xx, yy in zip(self.lines, xd, yd):
+            line.set_data(xx, yy)
+
+
+class DecimatedMesh():
+    """
+    pcolormesh of z (len(y), len(x)) with y decimated by peak_decimate to about one row per
+    pixel of the visible y range, rebuilt when the y limits change. kwargs go to pcolormesh.
+    """
+    def __init__(self, ax, x, y, z, npoints = None, **kwargs):
+        self.ax, self.x, self.y, self.z, self.npoints, self.kwargs = ax, np.asarray(x), np.asarray(y), z, npoints, kwargs
+        self.ylim = None
+        self.mesh = None
+        self.update()
+        ax.callbacks.connect('ylim_changed', lambda ax: self.update(ax.get_ylim()))
+
+    def update(self, ylim = None):
+        if ylim is not None and self.ylim is not None and np.allclose(ylim, self.ylim):
+            return
+        self.ylim = ylim
+        npoints = self.npoints or max(int(self.ax.bbox.height), 100)
+        yd, zd = peak_decimate(self.y, self.z, npoints, ylim)
+        if self.mesh is not None:
+            self.mesh.remove()
+        self.mesh = self.ax.pcolormesh(self.x, yd, zd, shading = 'auto', **self.kwargs)
+
+
+def dvcolorplot(sweep, dvs , levels = list(np.arange(-3.1e-3,3.1e-3,1e-5)), npoints = None):
     """
     Color plot of delta v vs time and freq
     
     Data input  is one $V_{bg}(\omega)$ and a  multindex Series for deltaVs with time and freq as levels
+    (or a DataArray with time and freq dims)
+
+    The colors are binned by levels as in a contour plot, but drawn as a mesh decimated along time 
+    to npoints rows (default one per pixel) of the visible time range, keeping the peaks.
     """
     
-    freq = dvs.index.levels[1]
-    time = dvs.index.levels[0]
-    z = dvs.values.reshape(len(time),len(freq))
-
-    xi, yi = np.meshgrid(freq,time)
+    time, freq, z = _time_freq(dvs)
 
     fig , axes = plt.subplots(2,1 , sharex = True,constrained_layout=True)
 
-    cs = axes[0].contourf(xi,yi,z, levels, cmap='seismic')
-    cb = fig.colorbar(cs, ax = axes[0])
+    cmap = plt.get_cmap('seismic', len(levels) - 1)
+    norm = mpl.colors.BoundaryNorm(levels, cmap.N)
+    dm = DecimatedMesh(axes[0], freq, time, z, npoints, cmap = cmap, norm = norm)
+    axes[0].set_ylim(time[0], time[-1])
+    cb = fig.colorbar(dm.mesh, ax = axes[0], ticks = mpl.ticker.MaxNLocator(7))
+    cb.minorticks_off()
+    axes[0].decimated = dm
 
 
     expf = exp_formatter(-9)
-    axes[0].yaxis.set_major_formatter(FuncFormatter(expf.format_func))
+    axes[0].yaxis.set_major_formatter(FuncFormatter(expf.func))
     axes[0].set_ylabel('Time (ns)')
     axes[1].set_xlabel('Freq (Hz)')
     axes[1].set_ylabel('Normalized\n Reflectivity')
@@ -49,25 +172,29 @@ def dvcolorplot(sweep, dvs , levels = list(np.arange(-3.1e-3,3.1e-3,1e-5))):
     return fig, axes    
 
 
-def absplot(dvs):
+def absplot(dvs, npoints = None):
     """
     Plots traces with negative integral as positive but red color
 
-    Data is multindex with time and freq as levels
+    Data is multindex with time and freq as levels (or a DataArray with time and freq dims)
+
+    Each trace is drawn decimated to the min and max of npoints bins (default one per pixel) 
+    of the visible time range.
     """
 
     fig, ax = plt.subplots()
 
-    for freq in dvs.index.levels[1]:
-        trace = dvs[:,freq]
-        if len(trace.shape) == 1:
-            if np.trapz(trace) > 0:
-                color = 'b'
-                zorder = 2
-            else:
-                color = 'r'
-                zorder = 1
-            ax.plot(abs(trace), color = color, zorder = zorder )
+    time, freq, z = _time_freq(dvs)
+    z = z.T
+    z = z[~np.isnan(z).all(axis = 1)]
+    
+    # sign of the integral of every trace at once
+    trapz = getattr(np, 'trapezoid', None) or np.trapz
+    positive = trapz(z, axis = 1) > 0
+
+    lines = [ax.plot([], [], color = 'b' if pos else 'r', zorder = 2 if pos else 1)[0] for pos in positive]
+    ax.decimated = DecimatedLines(ax, time, np.abs(z), lines, npoints)
+    ax.set_xlim(time[0], time[-1])
 
 
     ax.set_yscale('log')
@@ -76,7 +203,7 @@ def absplot(dvs):
     ax.set_xlabel('Time (ns)')
 
     expf = exp_formatter(-9)
-    ax.xaxis.set_major_formatter(FuncFormatter(expf.format_func))
+    ax.xaxis.set_major_formatter(FuncFormatter(expf.func))
     return fig, ax
 
 import pandas as pd
@@ -132,19 +259,60 @@ def vsplotxr(dv, vs = None, fit = None, v0 = None, fit_v0 = None , plotkwargs =
 
     return fig, axes, lns
 
-def inter_vsplot(timesel,dst_samp,lns,fig):
-    times = dst_samp.indexes['time']
+###Frames###
+# Animations and sliders pull every frame into one contiguous (time, freq) array up front
+# and index it by integer, rather than selecting by label on every frame.
+
+Frames = collections.namedtuple('Frames', ['times','x','data'])
+Frames.__doc__ = """times (ntime), x (nx) and a dict of (ntime, nx) arrays for each variable"""
+
+def get_frames(ds, names, dim = 'time', x = 'freq'):
+    """Frames of the variables names of ds along dim, other dims must be selected already"""
+    data = {name : np.ascontiguousarray(ds[name].transpose(dim, x).values, dtype = float) for name in names}
+    return Frames(np.asarray(ds.indexes[dim]), np.asarray(ds.indexes[x]), data)
+
+def nearest_frame(frames, t):
+    """index of the frame closest to time t"""
+    return int(np.abs(frames.times - t).argmin())
+
+def _vsplot_frames(dst_samp, lns, fig):
+    """frames of the lines lns, built once and kept on fig (as fig.vsplot_frames)"""
+    cached = getattr(fig, 'vsplot_frames', None)
+    if cached is None or cached[0] is not dst_samp or cached[1] != list(lns.index):
+        cached = (dst_samp, list(lns.index), get_frames(dst_samp, lns.index))
+        fig.vsplot_frames = cached
+    return cached[2]
+
+def inter_vsplot(timesel,dst_samp,lns,fig, frames = None):
+    """
+    Update the lines lns of vsplotxr to the time closest to timesel (ns)
+
+    frames - from get_frames(dst_samp, lns.index), by default built on the first call and kept
+             on fig for the next slider moves
+    """
+    if frames is None:
+        frames = _vsplot_frames(dst_samp, lns, fig)
     sample = dst_samp.coords['sample'].values.item()
-    timesel = timesel*1e-9
-    timesel = min(times, key=lambda x:abs(x-timesel))
+    i = nearest_frame(frames, timesel*1e-9)
+    timesel = frames.times[i]
     
     for name in lns.index:
         l = lns[name][0]
-        data = dst_samp[name].sel(time = timesel,method = 'nearest')
-        l.set_ydata(data)
+        l.set_ydata(frames.data[name][i])
         
     fig.suptitle('Sample : ' + str(sample) +  '\n$\Delta V(\omega)$ taken at ' + str(int(timesel*1e9))+ 'ns')
-    fig.canvas.draw()
+    fig.canvas.draw_idle()
+
+def inter_vsplot_fn(dst_samp, lns, fig):
+    """
+    inter_vsplot with the frames pulled out up front, for a slider
+
+    >>> interact(inter_vsplot_fn(dst_samp, lns, fig), timesel = (0, 1000, 10))
+    """
+    _vsplot_frames(dst_samp, lns, fig)
+    def update(timesel):
+        inter_vsplot(timesel, dst_samp, lns, fig)
+    return update
 
 # def vsplotxr(timesel, dvs, vss = None, fits = None, v0 = None, v0_fit = None):
 #     timesel = timesel *1e-9
@@ -192,14 +360,13 @@ def inter_vsplot(timesel,dst_samp,lns,fig):
 
 # First set up the figure, the axis, and the plot element we want to animate
 
-def sweepfitanim(dst,interval = 50):
-
-    fittimes = dst.indexes['time']
-    RawData_Frames = dst['vss'].loc[:,fittimes]
-    RawData_Frames_fit = dst['fits'].loc[:,fittimes]
-
-    # interval = 50
-    xs = dst.indexes['freq']
+def _sweepfit_figure(dst):
+    """figure, init and animate functions for the sweep fit animation of dst (vss and fits with time and freq dims)"""
+    frames = get_frames(dst, ['vss','fits'])
+    fittimes = frames.times
+    RawData_Frames = frames.data['vss']
+    RawData_Frames_fit = frames.data['fits']
+    xs = frames.x
 
     fig = plt.figure()
     ax = plt.axes(xlim=(xs[0], xs[-1]), ylim = (0.005,0.025))
@@ -210,6 +377,8 @@ def sweepfitanim(dst,interval = 50):
     time_template = 'Time = %.1fns'
     time_text = ax.text(0.05, 0.9, '', transform=ax.transAxes)
 
+    ax.set_ylabel("Voltage (V)")
+    ax.set_xlabel("Frequency (Hz)") 
     fig.tight_layout()
 
     # initialization function: plot the background of each frame
@@ -217,25 +386,46 @@ def sweepfitanim(dst,interval = 50):
         line.set_data([], [])
         line_fit.set_data([], [])
         time_text.set_text('')
-        ax.set_ylabel("Voltage (V)")
-        ax.set_xlabel("Frequency (Hz)") 
-        return line,line_fit
+        return line, line_fit, time_text
 
     # animation function.  This is called sequentially
     def animate(i):
-        line.set_data(xs, RawData_Frames.loc[:,fittimes[i]])
-        line_fit.set_data(xs, RawData_Frames_fit.loc[:,fittimes[i]])
+        line.set_data(xs, RawData_Frames[i])
+        line_fit.set_data(xs, RawData_Frames_fit[i])
         time_text.set_text(time_template % int(fittimes[i]*1e9))
-        return line, time_text
+        return line, line_fit, time_text
+
+    return fig, init, animate, len(fittimes)
+
+def sweepfitanim(dst,interval = 50):
+    """Animation of the sweeps (vss) and their fits over time"""
+    fig, init, animate, nframes = _sweepfit_figure(dst)
 
     # call the animator.  blit=True means only re-draw the parts that have changed.
     anim = animation.FuncAnimation(fig, animate, init_func=init,
-                                   frames=len(fittimes), interval = interval, blit=True)
+                                   frames=nframes, interval = interval, blit=True)
 
     rc('animation', html='html5')
 
     return anim
 
+def sweepfitvideo(dst, filepath, fps = 20, dpi = None, writer = None):
+    """
+    Write the sweepfitanim animation to a video one frame at a time, memory use doesn't depend on the number of frames
+
+    writer - a matplotlib MovieWriter, defaults to FFMpegWriter(fps) (needs ffmpeg)
+    """
+    fig, init, animate, nframes = _sweepfit_figure(dst)
+    if writer is None:
+        writer = animation.FFMpegWriter(fps = fps)
+    init()
+    with writer.saving(fig, filepath, dpi if dpi is not None else fig.dpi):
+        for i in range(nframes):
+            animate(i)
+            writer.grab_frame()
+    plt.close(fig)
+    return filepath
+
 def redbluetransient(ax,data,f0):
     freqs = data.indexes['freq']
     labeledblue = False
@@ -0,0 +1,116 @@
+"""
+Opt-in timing of the processing stages
+
+Stages record wall time, calls, bytes read and function evaluations of the fits. Nothing is
+recorded until enable() is called and a disabled stage costs one flag check. Times are inclusive,
+a stage that calls another (load_trace calling read_trace_file) includes its time. Stages run in
+worker processes are not recorded.
+
+>>> timing.enable()
+>>> s = load.freqfluence_load(load.freqfluence_flist(direc))
+>>> timing.report()
+"""
+import functools
+import threading
+import time
+
+import pandas as pd
+
+enabled = False
+_records = {}
+_lock = threading.Lock()
+
+columns = ['calls','seconds','bytes','nfev']
+
+
+def enable():
+    """Start recording"""
+    global enabled
+    enabled = True
+
+def disable():
+    """Stop recording, what was recorded is kept"""
+    global enabled
+    enabled = False
+
+def reset():
+    """Forget everything recorded"""
+    with _lock:
+        _records.clear()
+
+def record(name, calls = 0, seconds = 0, bytes = 0, nfev = 0):
+    """Add to the totals of a stage if recording is enabled"""
+    if not enabled:
+        return
+    with _lock:
+        r = _records.setdefault(name, [0, 0.0, 0, 0])
+        r[0] += calls
+        r[1] += seconds
+        r[2] += bytes
+        r[3] += nfev
+
+
+class stage():
+    """
+    Context manager timing a block as a stage
+
+    >>> with timing.stage('fit all'):
+    ...     fit_dcs(s_fps)
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter() if enabled else None
+        return self
+
+    def __exit__(self, *exc):
+        if self.t_start is not None:
+            record(self.name, calls = 1, seconds = time.perf_counter() - self.t_start)
+        return False
+
+def _stage_name(fn):
+    return fn.__module__.replace('trmc.', '') + '.' + fn.__qualname__
+
+def timed(fn = None, name = None):
+    """
+    Decorator recording every call of a function as a stage, named module.function by default
+
+    >>> @timing.timed
+    ... def parse(fp): ...
+    """
+    if fn is None:
+        return functools.partial(timed, name = name)
+    name = name or _stage_name(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return fn(*args, **kwargs)
+        t_start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(name, calls = 1, seconds = time.perf_counter() - t_start)
+    wrapper.stage = name
+    return wrapper
+
+def counted(fn, name):
+    """fn counting its calls as nfev of a stage, e.g. the model passed to curve_fit. fn itself when disabled."""
+    if not enabled:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        record(name, nfev = 1)
+        return fn(*args, **kwargs)
+    return wrapper
+
+def report():
+    """DataFrame of the recorded stages with their totals, time per call and read rate, slowest first"""
+    with _lock:
+        df = pd.DataFrame.from_dict({name : list(r) for name, r in _records.items()}, orient = 'index', columns = columns)
+    df.index.name = 'stage'
+    df['ms_per_call'] = 1e3*df['seconds']/df['calls'].where(df['calls'] > 0)
+    df['MB_per_s'] = 1e-6*df['bytes']/df['seconds'].where(df['seconds'] > 0)
+    return df.sort_values('seconds', ascending = False)